@@ -0,0 +1,219 @@
+"""Audit-Log: gepufferter Writer + monatlich partitionierte Tabelle.
+
+Handler rufen nur audit.log(...) auf (nicht blockierend, auch aus async-Code);
+ein Hintergrund-Thread schreibt die Events per COPY, sobald AUDIT_FLUSH_ROWS
+erreicht sind oder AUDIT_FLUSH_INTERVAL_MS vergangen ist. close() schreibt den
+Rest synchron (FastAPI-Shutdown, atexit, SIGTERM im Janitor/Verifier).
+
+Der Zeitstempel `at` wird beim Aufruf gesetzt, nicht beim Flush. Schlägt ein
+Flush fehl, bleiben die Events im Puffer (max. AUDIT_QUEUE_MAX, älteste fliegen
+zuerst raus) und werden beim nächsten Trigger erneut geschrieben.
+
+audit_log ist nach `at` monatlich partitioniert (audit_log_YYYYMM + default);
+alte Monate lassen sich per detach_before() ohne DELETE abhängen.
+"""
+import os, io, csv, json, atexit, threading
+from collections import deque
+from datetime import datetime, timezone
+from app.pool import get_pool
+
+FLUSH_ROWS = int(os.getenv("AUDIT_FLUSH_ROWS","500"))
+FLUSH_INTERVAL_S = int(os.getenv("AUDIT_FLUSH_INTERVAL_MS","1000")) / 1000.0
+QUEUE_MAX = int(os.getenv("AUDIT_QUEUE_MAX","100000"))
+PARTITIONS_AHEAD = int(os.getenv("AUDIT_PARTITIONS_AHEAD","2"))
+
+COPY_SQL = "copy audit_log(action, entity, entity_id, meta, at) from stdin with (format csv)"
+
+
+def _month(d, add=0):
+    m = d.year * 12 + d.month - 1 + add
+    return datetime(m // 12, m % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(d):
+    return f"audit_log_{d:%Y%m}"
+
+
+def ensure_partitions(cur, now=None, ahead=PARTITIONS_AHEAD, start=0):
+    """Legt audit_log_YYYYMM für die Monate start..ahead (relativ zu now) an."""
+    now = now or datetime.now(timezone.utc)
+    for i in range(start, ahead + 1):
+        lo, hi = _month(now, i), _month(now, i + 1)
+        cur.execute(f"create table if not exists {partition_name(lo)} partition of audit_log "
+                    "for values from (%s) to (%s)", (lo.isoformat(), hi.isoformat()))
+
+
+def ensure_schema(cur):
+    """Partitionierte audit_log anlegen; eine alte, unpartitionierte Tabelle wird migriert."""
+    cur.execute("select c.relkind from pg_class c where c.oid = to_regclass('audit_log')")
+    r = cur.fetchone()
+    legacy = bool(r and r[0] == "r")
+    if legacy:
+        cur.execute("alter table audit_log rename to audit_log_legacy")
+        cur.execute("alter sequence if exists audit_log_id_seq rename to audit_log_legacy_id_seq")
+        cur.execute("alter index if exists audit_log_pkey rename to audit_log_legacy_pkey")
+    cur.execute("""
+    create table if not exists audit_log(
+      id bigserial,
+      action text not null,
+      entity text not null,
+      entity_id uuid,
+      meta jsonb,
+      at timestamptz not null default now(),
+      primary key (id, at)
+    ) partition by range (at);""")
+    cur.execute("create table if not exists audit_log_default partition of audit_log default;")
+    # Lookups pro Entity (neueste zuerst); wird auf alle Partitionen vererbt
+    cur.execute("create index if not exists audit_log_entity_idx on audit_log (entity_id, at desc);")
+    if legacy:
+        cur.execute("select min(at), max(at) from audit_log_legacy")
+        lo, hi = cur.fetchone()
+        now = datetime.now(timezone.utc)
+        if lo is not None:
+            back = (now.year - lo.year) * 12 + now.month - lo.month
+            ensure_partitions(cur, now, start=-back)
+        ensure_partitions(cur, now)
+        cur.execute("insert into audit_log(id, action, entity, entity_id, meta, at) "
+                    "select id, action, entity, entity_id, meta, coalesce(at, now()) from audit_log_legacy")
+        cur.execute("select setval('audit_log_id_seq', coalesce((select max(id) from audit_log_legacy), 0) + 1, false)")
+        cur.execute("drop table audit_log_legacy")
+    else:
+        ensure_partitions(cur)
+
+
+def detach_before(cur, months: int, now=None):
+    """Hängt Monats-Partitionen ab, die komplett älter als `months` Monate sind -> Namen.
+    Die Tabellen bleiben bestehen (archivieren/droppen ist Sache des Betriebs)."""
+    cutoff = partition_name(_month(now or datetime.now(timezone.utc), -months))
+    cur.execute("""
+      select c.relname from pg_inherits i
+      join pg_class c on c.oid = i.inhrelid
+      where i.inhparent = 'audit_log'::regclass and c.relname ~ '^audit_log_[0-9]{6}$'
+      order by c.relname""")
+    old = [n for (n,) in cur.fetchall() if n < cutoff]
+    for n in old:
+        cur.execute(f"alter table audit_log detach partition {n}")
+    return old
+
+
+class AuditWriter:
+    def __init__(self, pool, flush_rows=FLUSH_ROWS, flush_interval_s=FLUSH_INTERVAL_S, queue_max=QUEUE_MAX):
+        self.pool = pool
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval_s = flush_interval_s
+        self.queue_max = queue_max
+        self._buf = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()   # ein Flush gleichzeitig (Thread vs. close())
+        self._closed = False
+        self._month = None
+        self._st = {"logged": 0, "written": 0, "flushes": 0, "errors": 0, "dropped": 0}
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def log(self, action, entity, entity_id=None, meta=None):
+        self.log_many([(action, entity, entity_id, meta)])
+
+    def log_many(self, events):
+        """events: [(action, entity, entity_id, meta-dict)]"""
+        at = datetime.now(timezone.utc)
+        with self._cond:
+            for action, entity, entity_id, meta in events:
+                self._buf.append((action, entity, entity_id, meta, at))
+            self._st["logged"] += len(events)
+            over = len(self._buf) - self.queue_max
+            for _ in range(max(over, 0)):
+                self._buf.popleft()
+            if over > 0:
+                self._st["dropped"] += over
+            if len(self._buf) >= self.flush_rows:
+                self._cond.notify()
+
+    def _copy(self, rows):
+        out = io.StringIO()
+        w = csv.writer(out)
+        for action, entity, entity_id, meta, at in rows:
+            # leeres, ungequotetes Feld = NULL
+            w.writerow((action, entity, entity_id or "", json.dumps(meta, default=str) if meta is not None else "",
+                        at.isoformat()))
+        out.seek(0)
+        with self.pool.cursor() as cur:
+            month = _month(rows[-1][4])
+            if month != self._month:
+                ensure_partitions(cur, month)
+                self._month = month
+            cur.copy_expert(COPY_SQL, out)
+
+    def flush(self):
+        """Schreibt den aktuellen Puffer (in Blöcken von flush_rows) -> geschriebene Events."""
+        n = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    rows = [self._buf.popleft() for _ in range(min(self.flush_rows, len(self._buf)))]
+                if not rows: return n
+                try:
+                    self._copy(rows)
+                except Exception as e:
+                    with self._cond:
+                        self._buf.extendleft(reversed(rows))
+                        self._st["errors"] += 1
+                    print(f"[audit] flush of {len(rows)} event(s) failed: {e}")
+                    raise
+                n += len(rows)
+                with self._cond:
+                    self._st["written"] += len(rows); self._st["flushes"] += 1
+
+    def _run(self):
+        failed = False
+        while True:
+            with self._cond:
+                # nach einem Fehler immer das Intervall abwarten (kein Hot-Loop bei DB-Ausfall)
+                if not self._closed and (failed or len(self._buf) < self.flush_rows):
+                    self._cond.wait(self.flush_interval_s)
+                if self._closed: return
+            try:
+                self.flush(); failed = False
+            except Exception:
+                failed = True   # Events bleiben im Puffer -> nächster Trigger
+
+    def close(self, timeout=10.0):
+        """Stoppt den Thread und schreibt den Rest synchron (Fehler werden geworfen)."""
+        with self._cond:
+            if self._closed: return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._st, buffered=len(self._buf))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer() -> AuditWriter:
+    """Prozessweiter Writer auf dem Pool aus get_pool(); flusht beim Beenden (atexit)."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = AuditWriter(get_pool())
+                atexit.register(close)
+    return _writer
+
+def log(action, entity, entity_id=None, meta=None):
+    get_writer().log(action, entity, entity_id, meta)
+
+def log_many(events):
+    get_writer().log_many(events)
+
+def stats():
+    """Stats des Writers; startet ihn nicht (Scrape vor dem ersten Event)."""
+    return _writer.stats() if _writer is not None else {}
+
+def close():
+    if _writer is not None:
+        _writer.close()
@@ -0,0 +1,422 @@
+"""Last-/Benchmark-Suite für api2 und den Janitor.
+
+Baut eine reproduzierbare Umgebung auf und misst die Hot Paths:
+  - Fake-S3: moto-Server im eigenen Prozess (echtes HTTP, presigned PUT funktioniert),
+  - Postgres: --database-url/DATABASE_URL oder ephemer (initdb + pg_ctl in einem
+    Temp-Verzeichnis, Binaries aus PATH bzw. PG_BIN),
+  - api2: uvicorn als Subprozess (--api-workers), damit Last-Client und API nicht
+    um dasselbe GIL konkurrieren,
+  - Datensatz: --rows file_object-Rows per generate_series (10k – 10M), davon
+    --expired-pct abgelaufen (Futter für den Janitor).
+Szenarien (--scenarios):
+  upload     presign2 -> PUT -> confirm2 (Teilschritte einzeln ausgewiesen)
+  list       /files/recent2 ab zufälligen Cursor-Positionen (Cache-Miss, Keyset über den Index)
+  list_head  erste Seite /files/recent2 (Dashboard-Polling, trifft den Listing-Cache)
+  delete     DELETE /files/{id} auf Seed-Rows
+  janitor    Cleanup-Sweep im Prozess (Latenz pro Batch, Durchsatz in Rows/s)
+Ergebnis: Durchsatz + p50/p95/p99 pro Szenario als JSON (--out). Mit --baseline wird
+gegen einen früheren Lauf verglichen; Exit-Code 1, wenn Durchsatz oder p95 um mehr
+als --tolerance schlechter sind. Scheitern mehr als --max-error-pct der Operationen
+eines Szenarios, ist es ungültig (valid=false, kein Vergleich, Exit-Code 2).
+
+Nie gegen eine produktive DB laufen lassen: Seed-Rows bleiben liegen, der Janitor
+löscht abgelaufene Rows, --reset leert file_object.
+Start: python -m app.bench --rows 100000 --ops 2000 --concurrency 16 --out bench.json
+Braucht zusätzlich requirements-bench.txt (moto).
+"""
+import os, sys, json, glob, time, random, shutil, socket, base64, argparse, platform, tempfile, threading, subprocess
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import psycopg2
+
+BUCKET = "artifacts"
+SCENARIOS = ("upload", "list", "list_head", "delete", "janitor")
+SEED_CHUNK = 1_000_000
+UPLOAD_CT = "text/plain"
+UPLOAD_MAX_DEFAULT = 10 * 1024 * 1024   # main.MAX_BYTES
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# --- Messung ---
+
+def percentile(sorted_ms, p):
+    """Nearest-Rank auf einer sortierten Liste."""
+    if not sorted_ms: return None
+    return sorted_ms[min(len(sorted_ms) - 1, max(0, -(-len(sorted_ms) * p // 100) - 1))]
+
+def summarize(lat_ms, errors, seconds, ops=None):
+    lat = sorted(lat_ms)
+    ops = len(lat) if ops is None else ops
+    r = lambda v: None if v is None else round(v, 3)
+    return {"ops": ops, "errors": errors, "seconds": round(seconds, 3),
+            "throughput_per_s": round(ops / seconds, 2) if seconds > 0 else None,
+            "p50_ms": r(percentile(lat, 50)), "p95_ms": r(percentile(lat, 95)),
+            "p99_ms": r(percentile(lat, 99)), "max_ms": r(lat[-1] if lat else None)}
+
+
+class Client:
+    """Keep-Alive-Connections pro Thread und Host (http.client, kein Extra-Paket)."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, url, body=None, headers=None):
+        u = urlsplit(url)
+        conns = self._local.__dict__.setdefault("conns", {})
+        for attempt in (0, 1):
+            conn = conns.get(u.netloc)
+            if conn is None:
+                conn = conns[u.netloc] = http.client.HTTPConnection(u.netloc, timeout=self.timeout)
+            try:
+                conn.request(method, u.path + ("?" + u.query if u.query else ""), body=body, headers=headers or {})
+                res = conn.getresponse()
+                return res.status, res.headers, res.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close(); del conns[u.netloc]       # Server hat Keep-Alive beendet -> einmal neu
+                if attempt: raise
+
+    def json(self, method, url, payload=None, expect=200):
+        body = json.dumps(payload).encode() if payload is not None else None
+        status, _, raw = self.request(method, url, body, {"Content-Type": "application/json"} if body else None)
+        if status != expect:
+            raise RuntimeError(f"{method} {urlsplit(url).path} -> {status}: {raw[:200]!r}")
+        return json.loads(raw) if raw else None
+
+
+def run_load(op, n, concurrency):
+    """op(i) n-mal mit concurrency Threads; op darf {schritt: ms} für Teilschritte liefern."""
+    lat, steps, errors = [], {}, [0]
+    lock = threading.Lock()
+    def one(i):
+        t0 = time.perf_counter()
+        try:
+            sub = op(i)
+        except Exception as e:
+            with lock:
+                errors[0] += 1
+                if errors[0] <= 3: print(f"[bench] error: {e}")
+            return
+        ms = (time.perf_counter() - t0) * 1000.0
+        with lock:
+            lat.append(ms)
+            for k, v in (sub or {}).items(): steps.setdefault(k, []).append(v)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max(1, concurrency)) as ex:
+        list(ex.map(one, range(n)))
+    seconds = time.perf_counter() - t0
+    out = summarize(lat, errors[0], seconds)
+    if steps: out["steps"] = {k: summarize(v, 0, seconds) for k, v in steps.items()}
+    return out
+
+
+# --- Umgebung ---
+
+def start_fake_s3():
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit("moto fehlt: pip install -r requirements-bench.txt")
+    import boto3
+    port = free_port()
+    srv = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    srv.start()
+    ep = f"http://127.0.0.1:{port}"
+    boto3.client("s3", endpoint_url=ep, aws_access_key_id="bench", aws_secret_access_key="bench",
+                 region_name="us-east-1").create_bucket(Bucket=BUCKET)
+    return srv, ep
+
+
+def pg_bin(name):
+    found = shutil.which(name, path=os.getenv("PG_BIN")) or shutil.which(name)
+    if not found:
+        found = next(iter(sorted(glob.glob(f"/usr/lib/postgresql/*/bin/{name}"), reverse=True)), None)
+    if not found:
+        sys.exit(f"{name} nicht gefunden (PG_BIN setzen oder --database-url angeben)")
+    return found
+
+
+def start_ephemeral_pg():
+    """Wegwerf-Cluster in einem Temp-Verzeichnis -> (dsn, stop)."""
+    d = tempfile.mkdtemp(prefix="api2-bench-pg-")
+    port = free_port()
+    subprocess.run([pg_bin("initdb"), "-D", os.path.join(d, "data"), "-U", "postgres", "-A", "trust",
+                    "--no-sync", "-E", "UTF8"], check=True, capture_output=True)
+    subprocess.run([pg_bin("pg_ctl"), "-D", os.path.join(d, "data"), "-w", "-l", os.path.join(d, "pg.log"),
+                    "-o", f"-p {port} -k {d} -c listen_addresses=127.0.0.1", "start"], check=True, capture_output=True)
+    def stop():
+        subprocess.run([pg_bin("pg_ctl"), "-D", os.path.join(d, "data"), "-m", "fast", "stop"], capture_output=True)
+        shutil.rmtree(d, ignore_errors=True)
+    return f"postgresql://postgres@127.0.0.1:{port}/postgres", stop
+
+
+def start_api(env, workers, client):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                             "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+                             "--no-access-log"], cwd=API_DIR, env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"api2 beendet (exit {proc.returncode})")
+        try:
+            if client.request("GET", base + "/ready")[0] == 200: return proc, base
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    sys.exit("api2 nicht rechtzeitig erreichbar")
+
+
+def seed(dsn, rows, expired_pct, reset):
+    """rows file_object-Rows (Schema vorher per migrate); expired_pct % davon
+    ephemer und älter als 2 Tage, der Rest über die letzten Stunden verteilt."""
+    conn = psycopg2.connect(dsn); conn.autocommit = True
+    cur = conn.cursor()
+    if reset:
+        cur.execute("truncate file_object cascade")
+    t0 = time.perf_counter()
+    for lo in range(0, rows, SEED_CHUNK):
+        hi = min(lo + SEED_CHUNK, rows)
+        cur.execute("""
+          insert into file_object(filename, size_bytes, content_type, s3_key, server_received_at, within_24h)
+          select 'bench-' || g || '.bin', 1024, 'application/octet-stream', 't-default/bench/' || g || '.bin',
+                 case when g %% 100 < %s then now() - interval '2 days' else now() end - g * interval '1 ms',
+                 g %% 100 < %s
+          from generate_series(%s, %s) g
+        """, (expired_pct, expired_pct, lo + 1, hi))
+        print(f"[bench] seeded {hi}/{rows} rows")
+    cur.execute("analyze file_object")
+    cur.execute("select count(*) from file_object")
+    total = cur.fetchone()[0]
+    conn.close()
+    return {"rows": rows, "rows_total": total, "seconds": round(time.perf_counter() - t0, 3)}
+
+
+def sample_rows(dsn, n, where="true"):
+    """n zufällige (server_received_at, id) per TABLESAMPLE – ohne Offset-Scan über 10M Rows."""
+    conn = psycopg2.connect(dsn)
+    with conn, conn.cursor() as cur:
+        cur.execute("select reltuples from pg_class where oid = 'file_object'::regclass")
+        total = max(float(cur.fetchone()[0] or 0), 1.0)
+        pct = min(100.0, n * 300.0 / total)
+        cur.execute(f"select server_received_at, id::text from file_object tablesample system (%s) "
+                    f"where {where} limit %s", (pct, n))
+        rows = cur.fetchall()
+        if len(rows) < n:   # kleine Tabellen / ungleich verteilte Blöcke
+            cur.execute(f"select server_received_at, id::text from file_object where {where} "
+                        f"order by random() limit %s", (n,))
+            rows = cur.fetchall()
+    conn.close()
+    random.shuffle(rows)
+    return rows
+
+
+def cursor_of(ts, fid):
+    # Format wie main.encode_cursor
+    return base64.urlsafe_b64encode(f"{ts.isoformat()}|{fid}".encode()).decode().rstrip("=")
+
+
+# --- Szenarien ---
+
+def bench_upload(c, base, args):
+    payload = os.urandom(args.object_kb * 1024)
+    ct = UPLOAD_CT        # muss in UPLOAD_ALLOWED_MIME stehen, sonst misst das Szenario nur 415er
+    def op(i):
+        t0 = time.perf_counter()
+        p = c.json("POST", base + "/files/presign2",
+                   {"filename": f"bench-up-{i}.txt", "content_type": ct, "size_bytes": len(payload)})
+        t1 = time.perf_counter()
+        status, _, raw = c.request("PUT", p["url"], payload, {"Content-Type": ct})
+        if status != 200: raise RuntimeError(f"PUT -> {status}: {raw[:200]!r}")
+        t2 = time.perf_counter()
+        c.json("POST", base + "/files/confirm2", {"file_id": p["file_id"]})
+        t3 = time.perf_counter()
+        return {"presign2": (t1 - t0) * 1000, "put": (t2 - t1) * 1000, "confirm2": (t3 - t2) * 1000}
+    return run_load(op, args.ops, args.concurrency)
+
+
+def bench_list(c, base, args, dsn):
+    cursors = [cursor_of(ts, fid) for ts, fid in sample_rows(dsn, args.ops)]
+    if not cursors: return None
+    def op(i):
+        c.json("GET", f"{base}/files/recent2?limit={args.page_size}&cursor={cursors[i % len(cursors)]}")
+    return run_load(op, args.ops, args.concurrency)
+
+
+def bench_list_head(c, base, args):
+    def op(i):
+        c.json("GET", f"{base}/files/recent2?limit={args.page_size}")
+    return run_load(op, args.ops, args.concurrency)
+
+
+def bench_delete(c, base, args, dsn):
+    ids = [fid for _, fid in sample_rows(dsn, args.ops, "not within_24h")]
+    if not ids: return None
+    def op(i):
+        c.json("DELETE", f"{base}/files/{ids[i]}")
+    return run_load(op, len(ids), args.concurrency)
+
+
+def bench_janitor(args):
+    """Sweep wie janitor.cleanup, aber mit Zeitmessung pro Batch."""
+    from app import janitor, audit      # ENV ist gesetzt -> Pool/S3 zeigen auf die Bench-Umgebung
+    lat, total, batches = [], 0, 0
+    t0 = time.perf_counter()
+    if args.janitor_mode == "claim":
+        while True:
+            t = time.perf_counter()
+            claimed, n = janitor.claim_batch(args.threshold_minutes, args.batch_size)
+            lat.append((time.perf_counter() - t) * 1000.0); total += n; batches += 1
+            if claimed < args.batch_size or n == 0: break
+    else:
+        for ids in janitor.iter_candidates(args.threshold_minutes, None, args.batch_size):
+            t = time.perf_counter()
+            total += janitor.process_batch(ids, args.threshold_minutes)
+            lat.append((time.perf_counter() - t) * 1000.0); batches += 1
+    seconds = time.perf_counter() - t0
+    audit.close()
+    out = summarize(lat, 0, seconds, ops=total)
+    out.update(unit="rows", batches=batches, batch_size=args.batch_size, mode=args.janitor_mode)
+    return out
+
+
+# --- Auswertung ---
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def error_pct(s):
+    attempted = s["ops"] + s["errors"]
+    return round(100.0 * s["errors"] / attempted, 2) if attempted else 0.0
+
+
+def compare(result, baseline, tolerance):
+    """-> Liste der Regressionen (Durchsatz runter oder p95 hoch, jeweils > tolerance).
+    Läufe mit zu vielen Fehlern (valid=False) sind nicht vergleichbar und werden übergangen."""
+    out = []
+    for name, s in result["scenarios"].items():
+        b = (baseline.get("scenarios") or {}).get(name)
+        if not s or not b or not s.get("valid", True) or not b.get("valid", True): continue
+        if s["throughput_per_s"] and b["throughput_per_s"] and s["throughput_per_s"] < b["throughput_per_s"] * (1 - tolerance):
+            out.append(f"{name}: throughput {b['throughput_per_s']} -> {s['throughput_per_s']}/s")
+        if s["p95_ms"] and b["p95_ms"] and s["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            out.append(f"{name}: p95 {b['p95_ms']} -> {s['p95_ms']} ms")
+    return out
+
+
+def print_table(result):
+    print(f"{'scenario':<12} {'ops':>8} {'err':>5} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, s in result["scenarios"].items():
+        if not s: continue
+        print(f"{name:<12} {s['ops']:>8} {s['errors']:>5} {s['throughput_per_s'] or 0:>10} "
+              f"{s['p50_ms'] or 0:>9} {s['p95_ms'] or 0:>9} {s['p99_ms'] or 0:>9}")
+        for step, t in (s.get("steps") or {}).items():
+            print(f"  {step:<10} {'':>8} {'':>5} {'':>10} {t['p50_ms'] or 0:>9} {t['p95_ms'] or 0:>9} {t['p99_ms'] or 0:>9}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="api2/Janitor-Benchmark mit Fake-S3 und lokalem Postgres")
+    ap.add_argument("--database-url", default=os.getenv("DATABASE_URL"),
+        help="vorhandene (Test-)DB; ohne Angabe wird ein ephemerer Cluster gestartet")
+    ap.add_argument("--rows", type=int, default=10_000, help="Seed-Rows in file_object (10k – 10M)")
+    ap.add_argument("--expired-pct", type=int, default=10, help="Anteil abgelaufener Seed-Rows (Janitor)")
+    ap.add_argument("--reset", action="store_true", help="file_object vor dem Seed leeren")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--ops", type=int, default=1000, help="Operationen pro Szenario")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--api-workers", type=int, default=1)
+    ap.add_argument("--object-kb", type=int, default=16, help="Payload pro Upload")
+    ap.add_argument("--page-size", type=int, default=50)
+    ap.add_argument("--batch-size", type=int, default=1000, help="Janitor-Batchgröße")
+    ap.add_argument("--janitor-mode", choices=["stream","claim"], default="stream")
+    ap.add_argument("--threshold-minutes", type=int, default=1440)
+    ap.add_argument("--label", default=None, help="frei wählbar, z.B. Version/Branch")
+    ap.add_argument("--out", default=None, help="Ergebnis als JSON")
+    ap.add_argument("--baseline", default=None, help="früheres Ergebnis-JSON zum Vergleich")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    ap.add_argument("--max-error-pct", type=float, default=1.0,
+        help="Szenario mit mehr fehlgeschlagenen Operationen gilt als ungültig (Exit-Code 2)")
+    args = ap.parse_args()
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown: ap.error(f"unbekannte Szenarien: {', '.join(sorted(unknown))}")
+
+    cleanup = []
+    try:
+        s3srv, s3ep = start_fake_s3(); cleanup.append(s3srv.stop)
+        dsn = args.database_url
+        if not dsn:
+            dsn, stop_pg = start_ephemeral_pg(); cleanup.append(stop_pg)
+        env = dict(os.environ, DATABASE_URL=dsn, S3_ENDPOINT=s3ep, PUBLIC_S3_ENDPOINT=s3ep,
+                   S3_ACCESS_KEY="bench", S3_SECRET_KEY="bench", S3_BUCKET=BUCKET)
+        # Upload-Szenario: Typ erlauben, Limit an --object-kb anpassen (Rest wie konfiguriert)
+        allowed = {m.strip() for m in env.get("UPLOAD_ALLOWED_MIME", "").split(",") if m.strip()}
+        if allowed and UPLOAD_CT not in allowed:
+            env["UPLOAD_ALLOWED_MIME"] = ",".join(sorted(allowed | {UPLOAD_CT}))
+        if args.object_kb * 1024 > int(env.get("UPLOAD_MAX_BYTES", UPLOAD_MAX_DEFAULT)):
+            env["UPLOAD_MAX_BYTES"] = str(args.object_kb * 1024)
+        os.environ.update(env)          # für den Janitor im eigenen Prozess
+        client = Client()
+        from app import migrate
+        conn = migrate.connect(dsn, 30)
+        try: migrate.migrate(conn)
+        finally: conn.close()
+        proc, base = start_api(env, args.api_workers, client)
+        cleanup.append(lambda: (proc.terminate(), proc.wait(10)))
+
+        result = {"meta": {"label": args.label, "git": git_rev(), "python": platform.python_version(),
+                           "platform": platform.platform(), "cpus": os.cpu_count(),
+                           "started_at": datetime.now(timezone.utc).isoformat(),
+                           "database": "external" if args.database_url else "ephemeral",
+                           "params": {k: v for k, v in vars(args).items()
+                                      if k not in ("database_url", "out", "baseline")}},
+                  "seed": seed(dsn, args.rows, args.expired_pct, args.reset),
+                  "scenarios": {}}
+        for name in scenarios:
+            print(f"[bench] {name} …")
+            if name == "upload": r = bench_upload(client, base, args)
+            elif name == "list": r = bench_list(client, base, args, dsn)
+            elif name == "list_head": r = bench_list_head(client, base, args)
+            elif name == "delete": r = bench_delete(client, base, args, dsn)
+            else: r = bench_janitor(args)
+            if r:
+                r["error_pct"] = error_pct(r)
+                r["valid"] = r["error_pct"] <= args.max_error_pct
+            result["scenarios"][name] = r
+    finally:
+        for fn in reversed(cleanup):
+            try: fn()
+            except Exception as e: print(f"[bench] cleanup: {e}")
+
+    print_table(result)
+    if args.out:
+        with open(args.out, "w") as f: json.dump(result, f, indent=2)
+        print(f"[bench] results -> {args.out}")
+    invalid = [n for n, s in result["scenarios"].items() if s and not s["valid"]]
+    for name in invalid:
+        s = result["scenarios"][name]
+        print(f"[bench] INVALID {name}: {s['errors']} errors ({s['error_pct']}%), {s['ops']} ok – Zahlen nicht verwertbar")
+    if args.baseline:
+        with open(args.baseline) as f: regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions: print(f"[bench] REGRESSION {line}")
+        if regressions: sys.exit(1)
+    if invalid: sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
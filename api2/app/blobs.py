@@ -0,0 +1,102 @@
+"""Content-addressed Blobs für Dedup (UPLOAD_DEDUP).
+
+Ein verifiziertes Objekt (verify_state = ok) wird als Blob in file_blob registriert
+(s3_key, sha256_hex, size_bytes, content_type, refcount). presign2 mit passendem
+sha256_hex legt statt eines neuen Uploads nur eine weitere file_object-Row auf
+denselben s3_key an und erhöht refcount.
+
+Löschen (API, Janitor) läuft zweistufig in einer Transaktion:
+  shared_keys() sperrt die Blob-Rows und liefert die Keys, die nach dem Löschen noch
+  referenziert sind -> S3-Objekt bleibt stehen; drop_refs() zählt die tatsächlich
+  gelöschten Rows herunter und entfernt Blobs ohne Referenz.
+Keys ohne file_blob-Row (nicht verifiziert, vor Dedup hochgeladen) gehören genau
+einer Row und werden wie bisher direkt gelöscht.
+Jede Operation gibt es für psycopg2 (cur) und asyncpg (*_async(conn)) – gleiches SQL.
+"""
+from collections import Counter
+from app.pool import numbered
+
+ACQUIRE_SQL = """
+  update file_blob set refcount = refcount + 1
+  where s3_key = (
+    select s3_key from file_blob
+    where sha256_hex=%s and size_bytes=%s and content_type=%s and refcount > 0
+    limit 1)
+    and refcount > 0
+  returning s3_key
+"""
+LOCK_SQL = "select s3_key, refcount from file_blob where s3_key = any(%s) for update"
+DROP_SQL = """
+  update file_blob b set refcount = b.refcount - d.n
+  from (select k, count(*) n from unnest(%s::text[]) k group by k) d
+  where b.s3_key = d.k
+"""
+PRUNE_SQL = "delete from file_blob where s3_key = any(%s) and refcount <= 0"
+
+
+def ensure_schema(cur):
+    cur.execute("""
+    create table if not exists file_blob(
+      s3_key text primary key,
+      sha256_hex text not null,
+      size_bytes bigint not null,
+      content_type text not null,
+      refcount int not null,
+      created_at timestamptz not null default now()
+    );""")
+    # Dedup-Lookup per Hash: Index-Suche statt Scan
+    cur.execute("create index if not exists file_blob_sha256_idx on file_blob (sha256_hex);")
+
+
+def register(cur, file_id):
+    """Verifier: verifiziertes Objekt als Blob mit einer Referenz eintragen."""
+    cur.execute("""
+      insert into file_blob(s3_key, sha256_hex, size_bytes, content_type, refcount)
+      select s3_key, sha256_hex, size_bytes, coalesce(content_type, 'application/octet-stream'), 1
+      from file_object where id=%s and sha256_hex is not null
+      on conflict (s3_key) do nothing
+    """, (file_id,))
+
+
+def acquire(cur, sha256_hex, size_bytes, content_type):
+    """Referenz auf einen vorhandenen Blob nehmen -> s3_key oder None.
+    refcount > 0 wird nach dem Row-Lock erneut geprüft (paralleles Löschen)."""
+    cur.execute(ACQUIRE_SQL, (sha256_hex, size_bytes, content_type))
+    r = cur.fetchone()
+    return r[0] if r else None
+
+
+async def acquire_async(conn, sha256_hex, size_bytes, content_type):
+    return await conn.fetchval(numbered(ACQUIRE_SQL), sha256_hex, size_bytes, content_type)
+
+
+def _still_referenced(rows, need) -> set:
+    return {k for k, rc in rows if rc > need[k]}
+
+
+def shared_keys(cur, keys) -> set:
+    """Sperrt die Blobs zu keys (eine Liste, ein Eintrag pro zu löschender Row) und
+    liefert die Keys, die danach noch referenziert sind."""
+    if not keys: return set()
+    need = Counter(keys)
+    cur.execute(LOCK_SQL, (list(need),))
+    return _still_referenced(cur.fetchall(), need)
+
+
+async def shared_keys_async(conn, keys) -> set:
+    if not keys: return set()
+    need = Counter(keys)
+    return _still_referenced(await conn.fetch(numbered(LOCK_SQL), list(need)), need)
+
+
+def drop_refs(cur, keys):
+    """Refcount um die Anzahl gelöschter Rows pro Key senken; leere Blobs entfernen."""
+    if not keys: return
+    cur.execute(DROP_SQL, (list(keys),))
+    cur.execute(PRUNE_SQL, (list(set(keys)),))
+
+
+async def drop_refs_async(conn, keys):
+    if not keys: return
+    await conn.execute(numbered(DROP_SQL), list(keys))
+    await conn.execute(numbered(PRUNE_SQL), list(set(keys)))
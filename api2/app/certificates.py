@@ -0,0 +1,302 @@
+"""Gate-Regeln aus config/certificate.yaml: kompiliert, vektorisiert über ganze Kohorten.
+
+Die Bedingungen unter rules.<Gate>.must sind kleine Ausdrücke
+("opt_in_pct >= 70", "NOT (ps_score < 3.0 AND efficacy_score < 3.0)", "VC == 5").
+Sie werden einmal geparst (eigener Tokenizer + rekursiver Abstieg, kein eval) und zu
+Funktionen über NumPy-Spalten kompiliert; ausgewertet wird pro Klausel eine
+Operation über alle Teilnehmer.
+
+  - Grammatik: OR < AND < NOT < Vergleich (>=, <=, >, <, ==, !=) zwischen Spalte,
+    Zahl oder true/false; Klammern; eine nackte Spalte heißt "!= 0",
+  - Gate bestanden = alle must-Klauseln wahr; fehlt ein Wert (None/NaN), gilt die
+    Klausel als nicht erfüllt (auch unter NOT),
+  - Note: grade_bands nach `min` auf der Spalte `score`; mit
+    finals.gate_fail_overrides_grade setzt ein nicht bestandenes Gate die unterste Stufe,
+  - kompilierte Regeln werden nach Config-Hash gecacht (Datei: zusätzlich nach mtime).
+"""
+import os, re, json, hashlib, threading
+from collections import OrderedDict
+import numpy as np
+import yaml
+
+CACHE_SIZE = 16
+SCORE_COLUMN = "score"
+MAX_RULE_CHARS = 1000
+MAX_DEPTH = 32          # Klammern/NOT verschachtelt; darüber RuleError statt RecursionError
+
+
+class RuleError(ValueError):
+    """Ungültige Regel, Config oder Eingabe."""
+
+
+# --- Parser ---
+
+_TOKEN = re.compile(r"\s*(?:(?P<num>-?(?:\d+(?:\.\d*)?|\.\d+))|(?P<op>>=|<=|==|!=|>|<)"
+                    r"|(?P<lp>\()|(?P<rp>\))|(?P<word>[A-Za-z_][A-Za-z0-9_]*))")
+_KEYWORDS = {"and", "or", "not", "true", "false"}
+
+
+def tokenize(text):
+    out, pos = [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m or m.end() == pos:
+            raise RuleError(f"unexpected character at {pos} in {text!r}")
+        kind = m.lastgroup; val = m.group(kind); at = m.start(kind)
+        if kind == "word" and val.lower() in _KEYWORDS:
+            kind, val = val.lower(), val.lower()
+        out.append((kind, val, at))
+        pos = m.end()
+    out.append(("end", None, len(text)))
+    return out
+
+
+class _Parser:
+    """Knoten: ("var", name) ("const", float) ("cmp", op, l, r) ("not", x) ("and", [..]) ("or", [..])"""
+
+    def __init__(self, text):
+        self.text, self.toks, self.i, self.depth = text, tokenize(text), 0, 0
+
+    def peek(self): return self.toks[self.i][0]
+
+    def nest(self, fn):
+        self.depth += 1
+        if self.depth > MAX_DEPTH: raise RuleError(f"nested deeper than {MAX_DEPTH} in {self.text!r}")
+        try: return fn()
+        finally: self.depth -= 1
+
+    def take(self, kind):
+        tok = self.toks[self.i]
+        if tok[0] != kind:
+            raise RuleError(f"expected {kind} at {tok[2]} in {self.text!r}, got {tok[1] or 'end'}")
+        self.i += 1
+        return tok[1]
+
+    def parse(self):
+        node = self.disj()
+        self.take("end")
+        return node
+
+    def disj(self):
+        parts = [self.conj()]
+        while self.peek() == "or":
+            self.i += 1; parts.append(self.conj())
+        return parts[0] if len(parts) == 1 else ("or", parts)
+
+    def conj(self):
+        parts = [self.neg()]
+        while self.peek() == "and":
+            self.i += 1; parts.append(self.neg())
+        return parts[0] if len(parts) == 1 else ("and", parts)
+
+    def neg(self):
+        if self.peek() == "not":
+            self.i += 1
+            return ("not", self.nest(self.neg))
+        return self.atom()
+
+    def atom(self):
+        if self.peek() == "lp":
+            self.i += 1
+            node = self.nest(self.disj)
+            self.take("rp")
+            return node
+        left = self.operand()
+        if self.peek() != "op":
+            if left[0] != "var": raise RuleError(f"bare constant in {self.text!r}")
+            return ("cmp", "!=", left, ("const", 0.0))
+        op = self.take("op")
+        return ("cmp", op, left, self.operand())
+
+    def operand(self):
+        kind = self.peek()
+        if kind == "num": return ("const", float(self.take("num")))
+        if kind in ("true", "false"): return ("const", 1.0 if self.take(kind) == "true" else 0.0)
+        if kind == "word": return ("var", self.take("word"))
+        tok = self.toks[self.i]
+        raise RuleError(f"expected value at {tok[2]} in {self.text!r}, got {tok[1] or 'end'}")
+
+
+def parse(text):
+    if not isinstance(text, str) or not text.strip():
+        raise RuleError(f"empty rule: {text!r}")
+    if len(text) > MAX_RULE_CHARS: raise RuleError(f"rule longer than {MAX_RULE_CHARS} characters")
+    return _Parser(text).parse()
+
+
+# --- Compiler: AST -> Funktion über {spalte: ndarray} ---
+
+_CMP = {">=": np.greater_equal, "<=": np.less_equal, ">": np.greater, "<": np.less,
+        "==": np.equal, "!=": np.not_equal}
+
+
+def variables(node, out=None):
+    out = set() if out is None else out
+    if node[0] == "var": out.add(node[1])
+    elif node[0] == "cmp": variables(node[2], out); variables(node[3], out)
+    elif node[0] == "not": variables(node[1], out)
+    elif node[0] in ("and", "or"):
+        for p in node[1]: variables(p, out)
+    return out
+
+
+def compile_node(node):
+    kind = node[0]
+    if kind == "var":
+        name = node[1]
+        return lambda cols: cols[name]
+    if kind == "const":
+        v = node[1]
+        return lambda cols: v
+    if kind == "cmp":
+        f, l, r = _CMP[node[1]], compile_node(node[2]), compile_node(node[3])
+        return lambda cols: f(l(cols), r(cols))
+    if kind == "not":
+        x = compile_node(node[1])
+        return lambda cols: np.logical_not(x(cols))
+    parts = [compile_node(p) for p in node[1]]
+    red = np.logical_and.reduce if kind == "and" else np.logical_or.reduce
+    return lambda cols: red([p(cols) for p in parts])
+
+
+class Clause:
+    __slots__ = ("gate", "text", "fn", "vars")
+
+    def __init__(self, gate, text):
+        node = parse(text)
+        self.gate, self.text = gate, text
+        self.fn = compile_node(node)
+        self.vars = sorted(variables(node))
+
+    def __call__(self, cols, known):
+        ok = self.fn(cols)
+        for v in self.vars: ok = ok & known[v]   # fehlender Wert -> Klausel nicht erfüllt
+        return ok
+
+
+# --- Regelsatz ---
+
+def _mapping(v, what):
+    """None -> {}; sonst muss es ein Dict sein (Inline-Config kommt ungeprüft vom Client)."""
+    if v is None: return {}
+    if not isinstance(v, dict): raise RuleError(f"{what} must be a mapping")
+    return v
+
+
+def _band_min(name, band):
+    v = _mapping(band, f"grade_bands.{name}").get("min", float("-inf"))
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or np.isnan(v):
+        raise RuleError(f"grade_bands.{name}.min must be a number")
+    return float(v)
+
+
+class CompiledRules:
+    def __init__(self, cfg, config_hash):
+        self.config_hash = config_hash
+        cfg = _mapping(cfg, "config")
+        rules = _mapping(cfg.get("rules"), "rules")
+        if not rules: raise RuleError("config has no rules")
+        self.gates = list(rules)
+        self.clauses = []
+        for gate, spec in rules.items():
+            must = _mapping(spec, f"rules.{gate}").get("must") or []
+            if not isinstance(must, list): raise RuleError(f"{gate}.must must be a list")
+            self.clauses += [Clause(gate, str(t)) for t in must]
+        self.slices = {}
+        for g in self.gates:
+            idx = [i for i, c in enumerate(self.clauses) if c.gate == g]
+            self.slices[g] = slice(idx[0], idx[-1] + 1) if idx else slice(0, 0)
+        # Stufen aufsteigend nach min; ohne min = Auffangstufe (unterste)
+        bands = _mapping(cfg.get("grade_bands"), "grade_bands")
+        ordered = sorted(((n, _band_min(n, b)) for n, b in bands.items()), key=lambda kv: kv[1])
+        self.band_names = [n for n, _ in ordered]
+        self.band_mins = np.array([m for _, m in ordered])
+        self.fail_band = self.band_names[0] if self.band_names else None
+        self.overrides = bool(_mapping(cfg.get("finals"), "finals").get("gate_fail_overrides_grade"))
+        self.columns = sorted({v for c in self.clauses for v in c.vars} | ({SCORE_COLUMN} if self.band_names else set()))
+
+    def evaluate(self, columns, details=True):
+        """columns: {name: Sequenz gleicher Länge} (bool/Zahl/None) -> Ergebnis spaltenweise."""
+        n = None
+        for name, col in columns.items():
+            if n is None: n = len(col)
+            elif len(col) != n: raise RuleError(f"column {name!r} has {len(col)} values, expected {n}")
+        n = n or 0
+        cols = {name: as_array(columns[name], name) if name in columns else np.full(n, np.nan)
+                for name in self.columns}
+        known = {name: ~np.isnan(a) for name, a in cols.items()}
+        passed = np.empty((len(self.clauses), n), dtype=bool)
+        for i, c in enumerate(self.clauses):
+            passed[i] = c(cols, known)
+        gates = {g: passed[self.slices[g]].all(axis=0) for g in self.gates}
+        all_passed = np.logical_and.reduce(list(gates.values())) if gates else np.ones(n, dtype=bool)
+        out = {"n": n, "config_hash": self.config_hash,
+               "gates": {g: v.tolist() for g, v in gates.items()},
+               "passed": all_passed.tolist(),
+               "missing_columns": [c for c in self.columns if c not in columns]}
+        if self.band_names:
+            score = cols[SCORE_COLUMN]
+            idx = np.searchsorted(self.band_mins, np.nan_to_num(score, nan=-np.inf), side="right") - 1
+            names = np.array(self.band_names + [None], dtype=object)
+            by_score = names[np.where(known[SCORE_COLUMN] & (idx >= 0), idx, len(self.band_names))]
+            grade = by_score.copy()
+            if self.overrides: grade[~all_passed] = self.fail_band
+            out["grade_by_score"] = by_score.tolist()
+            out["grade"] = grade.tolist()
+        if details:
+            labels = np.array([f"{c.gate}: {c.text}" for c in self.clauses], dtype=object)
+            failing = ~passed.T
+            out["failing"] = [labels[row].tolist() for row in failing]
+        return out
+
+
+def as_array(col, name=""):
+    try:
+        return np.asarray(col, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return np.array([np.nan if v is None else float(v) for v in col], dtype=np.float64)
+    except (TypeError, ValueError):
+        raise RuleError(f"column {name!r}: only numbers, booleans and null are allowed")
+
+
+# --- Cache ---
+
+_cache = OrderedDict()
+_files = {}
+_lock = threading.Lock()
+
+
+def config_hash(cfg) -> str:
+    return hashlib.sha256(json.dumps(cfg, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+
+def compiled(cfg) -> CompiledRules:
+    """Kompilierte Regeln zum Config-Dict (LRU nach Hash, CACHE_SIZE Einträge)."""
+    h = config_hash(cfg)
+    with _lock:
+        r = _cache.get(h)
+        if r is not None:
+            _cache.move_to_end(h); return r
+    r = CompiledRules(cfg, h)
+    with _lock:
+        _cache[h] = r
+        while len(_cache) > CACHE_SIZE: _cache.popitem(last=False)
+    return r
+
+
+def from_file(path) -> CompiledRules:
+    """YAML nur neu lesen, wenn sich mtime/Größe geändert haben."""
+    st = os.stat(path)
+    sig = (st.st_mtime_ns, st.st_size)
+    with _lock:
+        hit = _files.get(path)
+    if hit and hit[0] == sig: return compiled(hit[1])
+    with open(path, encoding="utf-8-sig") as f:
+        cfg = yaml.safe_load(f)
+    if not isinstance(cfg, dict): raise RuleError(f"{path}: not a mapping")
+    with _lock:
+        _files[path] = (sig, cfg)
+    return compiled(cfg)
@@ -0,0 +1,296 @@
+"""EXIF-Worker: füllt file_object.exif_taken_at im Hintergrund.
+
+confirm2 legt für Bilder (JPEG/PNG/WebP) einen Job in exif_job an; dieser Worker
+  - claimt Jobs blockweise per Lease (FOR UPDATE SKIP LOCKED) -> mehrere Replicas ok,
+  - liest pro Bild nur den Anfang per Ranged GET (EXIF_RANGE_KB) und, falls der
+    EXIF-Block weiter hinten liegt (WebP/PNG-Chunks nach den Bilddaten), wenige
+    gezielte Nachlese-Ranges – nie das ganze Objekt,
+  - parst den TIFF-Header in einem Prozess-Pool (EXIF_WORKERS),
+  - schreibt die Ergebnisse eines Blocks mit einem Update zurück.
+DateTimeOriginal ohne OffsetTimeOriginal wird als UTC gespeichert.
+Start: python -m app.exif
+"""
+import os, sys, time, select, signal, struct, argparse
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor
+import psycopg2, psycopg2.extras
+from app.pool import get_pool, numbered
+from app.storage import S3Storage
+
+DB_URL = os.getenv("DATABASE_URL")
+S3_BUCKET = os.getenv("S3_BUCKET","artifacts")
+EXIF_CHANNEL = "exif_jobs"
+EXIF_TYPES = {"image/jpeg", "image/png", "image/webp"}
+WORKERS = int(os.getenv("EXIF_WORKERS","4"))
+BATCH = int(os.getenv("EXIF_BATCH","64"))
+RANGE_BYTES = int(os.getenv("EXIF_RANGE_KB","64")) * 1024
+MAX_READS = 8                  # Ranged GETs pro Bild (inkl. erstem)
+MAX_EXIF_BYTES = 256 * 1024
+LEASE_S = int(os.getenv("EXIF_LEASE_S","300"))
+MAX_ATTEMPTS = int(os.getenv("EXIF_MAX_ATTEMPTS","3"))
+
+
+def ensure_schema(cur):
+    cur.execute("""
+    create table if not exists exif_job(
+      file_id uuid primary key references file_object(id) on delete cascade,
+      s3_key text not null,
+      size_bytes bigint not null,
+      content_type text not null,
+      enqueued_at timestamptz not null default now(),
+      attempts int not null default 0,
+      leased_until timestamptz
+    );""")
+
+
+def wants(content_type) -> bool:
+    return content_type in EXIF_TYPES
+
+
+# Multi-Row per unnest: ein Statement für psycopg2 und asyncpg (numbered)
+ENQUEUE_SQL = """
+  insert into exif_job(file_id, s3_key, size_bytes, content_type)
+  select * from unnest(%s::uuid[], %s::text[], %s::bigint[], %s::text[])
+  on conflict (file_id) do update
+    set s3_key=excluded.s3_key, size_bytes=excluded.size_bytes, content_type=excluded.content_type,
+        attempts=0, leased_until=null, enqueued_at=now()
+"""
+NOTIFY_SQL = "select pg_notify(%s, '')"
+
+
+def _columns(jobs):
+    """[(file_id, s3_key, size, content_type)] -> Spalten-Arrays der relevanten Jobs (leer: None)."""
+    jobs = [j for j in jobs if wants(j[3])]
+    if not jobs: return None
+    return ([str(j[0]) for j in jobs], [j[1] for j in jobs], [j[2] for j in jobs], [j[3] for j in jobs])
+
+
+def enqueue_many(cur, jobs):
+    """jobs: [(file_id, s3_key, size, content_type)]; Nicht-Bilder werden übergangen."""
+    cols = _columns(jobs)
+    if not cols: return
+    cur.execute(ENQUEUE_SQL, cols)
+    cur.execute(NOTIFY_SQL, (EXIF_CHANNEL,))
+
+
+async def enqueue_many_async(conn, jobs):
+    """Async-Modus (asyncpg-Connection in laufender Transaktion)."""
+    cols = _columns(jobs)
+    if not cols: return
+    await conn.execute(numbered(ENQUEUE_SQL), *cols)
+    await conn.execute(numbered(NOTIFY_SQL), EXIF_CHANNEL)
+
+
+# --- Parser (reine Funktionen, laufen im Prozess-Pool) ---
+
+class RangeReader:
+    """[start, end) lesen; der Dateianfang ist gepuffert, weitere Ranged GETs sind
+    auf max_reads begrenzt (EOFError, wenn das Budget aufgebraucht ist)."""
+
+    def __init__(self, fetch, size, head_bytes=RANGE_BYTES, max_reads=MAX_READS):
+        self.fetch, self.size, self.max_reads = fetch, size, max_reads
+        self.reads = 0
+        self.head = self._fetch(0, min(head_bytes, size))
+
+    def _fetch(self, start, end):
+        if self.reads >= self.max_reads:
+            raise EOFError("read budget exhausted")
+        self.reads += 1
+        return self.fetch(start, end)
+
+    def get(self, start, end):
+        end = min(end, self.size)
+        if start >= end: return b""
+        if end <= len(self.head): return self.head[start:end]
+        return self._fetch(start, end)
+
+
+def _jpeg_tiff(r):
+    if r.head[:2] != b"\xff\xd8": return None
+    p = 2
+    while True:
+        hdr = r.get(p, p + 4)
+        if len(hdr) < 4 or hdr[0] != 0xFF: return None
+        marker = hdr[1]
+        if marker == 0xFF: p += 1; continue          # Füllbytes
+        if marker in (0xD9, 0xDA): return None       # EOI/SOS: danach keine Metadaten
+        n = struct.unpack(">H", hdr[2:4])[0]
+        if marker == 0xE1 and r.get(p + 4, p + 10) == b"Exif\x00\x00":
+            return r.get(p + 10, p + 2 + n)
+        p += 2 + n
+
+
+def _png_tiff(r):
+    if r.head[:8] != b"\x89PNG\r\n\x1a\n": return None
+    p = 8
+    while True:
+        hdr = r.get(p, p + 8)
+        if len(hdr) < 8: return None
+        n, typ = struct.unpack(">I4s", hdr)
+        if typ == b"eXIf": return r.get(p + 8, p + 8 + min(n, MAX_EXIF_BYTES))
+        if typ == b"IEND": return None
+        p += 12 + n
+
+
+def _webp_tiff(r):
+    if r.head[:4] != b"RIFF" or r.head[8:12] != b"WEBP": return None
+    # nur VP8X kann EXIF tragen; Flag-Bit 3 = EXIF vorhanden -> sonst keine Nachlese
+    if r.head[12:16] != b"VP8X" or not (r.head[20:21] and r.head[20] & 0x08): return None
+    p = 12
+    while True:
+        hdr = r.get(p, p + 8)
+        if len(hdr) < 8: return None
+        typ, n = struct.unpack("<4sI", hdr)
+        if typ == b"EXIF":
+            data = r.get(p + 8, p + 8 + min(n, MAX_EXIF_BYTES))
+            return data[6:] if data[:6] == b"Exif\x00\x00" else data
+        p += 8 + n + (n & 1)
+
+
+def _exif_time(s, offset):
+    try:
+        dt = datetime.strptime(s[:19], "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None                                  # z.B. "0000:00:00 00:00:00"
+    tz = timezone.utc
+    if offset and len(offset) >= 6 and offset[0] in "+-":
+        try:
+            h, m = int(offset[1:3]), int(offset[4:6])
+            tz = timezone((1 if offset[0] == "+" else -1) * timedelta(hours=h, minutes=m))
+        except ValueError:
+            pass
+    return dt.replace(tzinfo=tz)
+
+
+def parse_tiff(t: bytes):
+    """TIFF/EXIF-Block -> Aufnahmezeitpunkt (DateTimeOriginal > Digitized > DateTime) oder None."""
+    if len(t) < 8: return None
+    e = {b"II": "<", b"MM": ">"}.get(t[:2])
+    if not e or struct.unpack(e + "H", t[2:4])[0] != 42: return None
+
+    def ifd(off):
+        if off <= 0 or off + 2 > len(t): return {}
+        out = {}
+        for i in range(struct.unpack(e + "H", t[off:off + 2])[0]):
+            q = off + 2 + 12 * i
+            if q + 12 > len(t): break
+            tag, typ, cnt = struct.unpack(e + "HHI", t[q:q + 8])
+            out[tag] = (typ, cnt, q + 8)
+        return out
+
+    def text(entry):
+        if not entry or entry[0] != 2: return None
+        _, cnt, q = entry
+        if cnt > 4: q = struct.unpack(e + "I", t[q:q + 4])[0]
+        return t[q:q + cnt].split(b"\x00")[0].decode("ascii", "ignore").strip() or None
+
+    ifd0 = ifd(struct.unpack(e + "I", t[4:8])[0])
+    ptr = ifd0.get(0x8769)
+    sub = ifd(struct.unpack(e + "I", t[ptr[2]:ptr[2] + 4])[0]) if ptr and ptr[0] in (4, 13) else {}
+    for tag, off_tag, src in ((0x9003, 0x9011, sub), (0x9004, 0x9012, sub), (0x0132, 0x9010, ifd0)):
+        s = text(src.get(tag))
+        if s:
+            dt = _exif_time(s, text(sub.get(off_tag)))
+            if dt: return dt
+    return None
+
+
+PARSERS = {"image/jpeg": _jpeg_tiff, "image/png": _png_tiff, "image/webp": _webp_tiff}
+
+def taken_at(fetch, size, content_type):
+    """fetch(start, end) -> bytes; liest nur die nötigen Ranges."""
+    if size <= 0 or content_type not in PARSERS: return None
+    try:
+        tiff = PARSERS[content_type](RangeReader(fetch, size))
+    except EOFError:
+        return None
+    return parse_tiff(tiff) if tiff else None
+
+
+# --- Worker ---
+
+_storage = None
+
+def _init_process():
+    global _storage
+    _storage = S3Storage(S3_BUCKET, os.getenv("S3_ENDPOINT"), os.getenv("S3_ACCESS_KEY"), os.getenv("S3_SECRET_KEY"))
+
+def extract_job(job):
+    """Im Pool-Prozess: -> (file_id, taken_at|None, Fehlertext|None)."""
+    fid, key, size, ctype, _ = job
+    try:
+        return fid, taken_at(lambda a, b: _storage.read_range(key, a, b), size, ctype), None
+    except Exception as ex:
+        return fid, None, f"{type(ex).__name__}: {ex}"[:200]
+
+
+def claim(pool, n):
+    with pool.cursor() as cur:
+        cur.execute("""
+          update exif_job set leased_until = now() + (%s)::interval, attempts = attempts + 1
+          where file_id in (
+            select file_id from exif_job
+            where leased_until is null or leased_until < now()
+            order by enqueued_at
+            limit %s
+            for update skip locked)
+          returning file_id::text, s3_key, size_bytes, content_type, attempts
+        """, (f"{LEASE_S} seconds", n))
+        return cur.fetchall()
+
+
+def store(pool, jobs, results):
+    """Ergebnisse eines Blocks schreiben; fehlgeschlagene Jobs bleiben bis MAX_ATTEMPTS liegen."""
+    attempts = {j[0]: j[4] for j in jobs}
+    found = [(fid, t) for fid, t, err in results if t]
+    done = [fid for fid, _, err in results if err is None or attempts[fid] >= MAX_ATTEMPTS]
+    for fid, _, err in results:
+        if err is not None: print(f"[exif] {fid}: {err} (attempt {attempts[fid]})")
+    with pool.cursor() as cur:
+        if found:
+            psycopg2.extras.execute_values(cur, """
+              update file_object f set exif_taken_at = v.t
+              from (values %s) v(id, t) where f.id = v.id
+            """, found, template="(%s::uuid,%s::timestamptz)", page_size=1000)
+        if done:
+            cur.execute("delete from exif_job where file_id = any(%s::uuid[])", (done,))
+    return len(found)
+
+
+def listen():
+    conn = psycopg2.connect(DB_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"listen {EXIF_CHANNEL}")
+    return conn
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--poll-seconds", type=float, default=float(os.getenv("EXIF_POLL_SECONDS","30")),
+        help="Fallback-Poll, falls ein NOTIFY verloren geht")
+    args = ap.parse_args()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    pool = get_pool(dsn=DB_URL, minconn=0, maxconn=2)
+    procs = ProcessPoolExecutor(max(1, WORKERS), initializer=_init_process)
+    print(f"[exif] workers={WORKERS} batch={BATCH} range={RANGE_BYTES} bytes")
+    listener = None
+    while True:
+        try:
+            if listener is None or listener.closed:
+                listener = listen()
+            jobs = claim(pool, BATCH)
+            if jobs:
+                n = store(pool, jobs, list(procs.map(extract_job, jobs, chunksize=max(1, len(jobs) // (WORKERS * 4)))))
+                print(f"[exif] {len(jobs)} job(s), {n} with taken_at")
+                if len(jobs) == BATCH: continue        # Rückstau -> sofort weiter
+            if select.select([listener], [], [], args.poll_seconds) != ([], [], []):
+                listener.poll(); listener.notifies.clear()
+        except Exception as e:
+            print(f"[exif] ERROR: {e}")
+            listener = None
+            time.sleep(5)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
-import os, time, argparse, psycopg2, psycopg2.extras, boto3
+import os, sys, time, select, signal, argparse, psycopg2, psycopg2.extras, boto3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from botocore.config import Config
+from botocore.exceptions import ClientError
+from app.pool import get_pool
+from app import audit, blobs, thumbs, metrics
 
 DB_URL = os.getenv("DATABASE_URL")
 S3_ENDPOINT = os.getenv("S3_ENDPOINT")
@@ -13,53 +18,283 @@ s3 = boto3.client("s3",
     aws_secret_access_key=S3_SECRET_KEY,
     config=Config(s3={"addressing_style":"path"}, signature_version="s3v4"),
     region_name="us-east-1")
+metrics.instrument_boto(s3)
 
-def db(): return psycopg2.connect(DB_URL)
+CHANGED_CHANNEL = "file_object_changed"
+BATCH_SIZE = 1000   # Obergrenze von S3 DeleteObjects
+EXPIRED = "within_24h = true and server_received_at < now() - (%s)::interval"
+DELETERS = int(os.getenv("CLEANUP_DELETERS","4"))
+# Claim-Modus: die Row-Locks einer Batch-Transaktion sind der Lease. Stirbt ein
+# Replica, rollt Postgres zurück; hängt es, beendet idle_in_transaction_session_timeout
+# (nur in der Claim-Transaktion gesetzt) die Session nach CLEANUP_LEASE_TIMEOUT_S
+# und gibt die Rows frei.
+LEASE_TIMEOUT_S = int(os.getenv("CLEANUP_LEASE_TIMEOUT_S","300"))
 
-def cleanup(threshold_minutes: int, only_file_id: str|None=None) -> int:
-    conn = db(); cur = conn.cursor()
-    if only_file_id:
-        cur.execute("select id::text, s3_key from file_object where id=%s",(only_file_id,))
-    else:
+# Lese-Cursor (Stream-Modus) + Schreib-Connection pro Batch + Audit-Writer-Thread
+# -> mindestens 3; eigener Knopf, weil DB_POOL_MAX für die API dimensioniert ist
+POOL_MAX = max(3, int(os.getenv("JANITOR_DB_POOL_MAX","3")))
+pool = get_pool(dsn=DB_URL, minconn=0, maxconn=POOL_MAX)
+_deleters = None
+
+def deleters():
+    global _deleters
+    if _deleters is None:
+        _deleters = ThreadPoolExecutor(max_workers=max(1, DELETERS), thread_name_prefix="s3-delete")
+    return _deleters
+
+def iter_candidates(threshold_minutes: int, only_file_id: str|None=None, batch_size: int=BATCH_SIZE):
+    """Streamt Kandidaten-IDs blockweise über einen Server-Side-Cursor (konstanter Speicher)."""
+    with pool.connection() as conn:
+        with conn.cursor(name="janitor_candidates") as cur:
+            cur.itersize = batch_size
+            if only_file_id:
+                cur.execute("select id::text from file_object where id=%s",(only_file_id,))
+            else:
+                cur.execute(f"select id::text from file_object where {EXPIRED}",(f"{threshold_minutes} minutes",))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows: break
+                yield [r[0] for r in rows]
+
+def delete_objects(keys) -> set:
+    """S3 DeleteObjects (Quiet) -> Menge der Keys, die nicht gelöscht werden konnten."""
+    try:
+        res = s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects":[{"Key":k} for k in keys], "Quiet":True})
+    except Exception as e:
+        print(f"[warn] S3 DeleteObjects failed for {len(keys)} key(s): {e}")
+        return set(keys)
+    failed = set()
+    for e in res.get("Errors") or []:
+        print(f"[warn] S3 delete failed for {e.get('Key')}: {e.get('Code')} {e.get('Message')}")
+        failed.add(e.get("Key"))
+    return failed
+
+def delete_objects_parallel(keys) -> set:
+    """Verteilt einen Batch auf bis zu DELETERS parallele DeleteObjects-Calls."""
+    if not keys: return set()
+    n = max(1, min(DELETERS, len(keys)))
+    if n == 1:
+        return delete_objects(keys)
+    step = -(-len(keys) // n)
+    failed = set()
+    for f in deleters().map(delete_objects, [keys[i:i+step] for i in range(0, len(keys), step)]):
+        failed |= f
+    return failed
+
+def purge(cur, rows) -> list:
+    """rows (id, s3_key) sind gesperrt: S3 löschen, Rows bulk löschen -> [(id, s3_key)].
+    Commit macht der Aufrufer, danach audit_deleted()."""
+    # Dedup-Blobs, die noch andere Rows referenzieren, bleiben in S3 liegen
+    shared = blobs.shared_keys(cur, [k for _, k in rows])
+    gone = sorted({k for _, k in rows} - shared)
+    # Renditions (Thumbnails) gehen mit dem Original; ihr Fehlschlag hält die Row nicht auf
+    failed = delete_objects_parallel(gone + [thumbs.thumb_key(k) for k in gone])
+    metrics.JANITOR_S3_FAILED.inc(len(failed))
+    # Rows mit fehlgeschlagenem S3-Delete bleiben stehen -> nächster Sweep versucht es erneut
+    done = [fid for fid, k in rows if k not in failed]
+    if not done: return []
+    cur.execute("delete from file_object where id = any(%s::uuid[]) returning id::text, s3_key",(done,))
+    deleted = cur.fetchall()
+    blobs.drop_refs(cur, [k for _, k in deleted])
+    # API-Listing-Caches invalidieren (Zustellung beim Commit)
+    if deleted: cur.execute("select pg_notify(%s, '')", (CHANGED_CHANNEL,))
+    return deleted
+
+def audit_deleted(deleted) -> int:
+    metrics.JANITOR_DELETED.inc(len(deleted))
+    audit.log_many([("files.cleanup","file_object",fid,{"s3_key":key,"by":"janitor"}) for fid, key in deleted])
+    return len(deleted)
+
+def process_batch(ids, threshold_minutes: int, only_file_id: str|None=None) -> int:
+    """Ein Batch = eine Transaktion: sperren, S3 löschen, Rows bulk löschen, commit, Audit."""
+    with pool.connection() as conn, conn.cursor() as cur:
+        # erneut prüfen + sperren: Retention kann sich seit dem Lesen geändert haben
+        if only_file_id:
+            cur.execute("select id::text, s3_key from file_object where id = any(%s::uuid[]) for update",(ids,))
+        else:
+            cur.execute(f"select id::text, s3_key from file_object where id = any(%s::uuid[]) and {EXPIRED} for update",
+                (ids, f"{threshold_minutes} minutes"))
+        rows = cur.fetchall()
+        if rows: metrics.JANITOR_BATCH_ROWS.observe(len(rows))
+        deleted = purge(cur, rows) if rows else []
+    return audit_deleted(deleted)
+
+def claim_batch(threshold_minutes: int, batch_size: int=BATCH_SIZE):
+    """Claim-Modus: nimmt bis zu batch_size abgelaufene Rows, die kein anderes Replica hält.
+    -> (geclaimt, gelöscht)"""
+    with pool.connection() as conn, conn.cursor() as cur:
+        # Lease-Timeout nur für diese Transaktion – der Stream-Reader darf länger idle sein
+        cur.execute("select set_config('idle_in_transaction_session_timeout', %s, true)",
+                    (str(LEASE_TIMEOUT_S*1000),))
+        cur.execute(f"""
+          select id::text, s3_key from file_object
+          where {EXPIRED}
+          order by server_received_at
+          limit %s
+          for update skip locked
+        """,(f"{threshold_minutes} minutes", batch_size))
+        rows = cur.fetchall()
+        if rows: metrics.JANITOR_BATCH_ROWS.observe(len(rows))
+        deleted = purge(cur, rows) if rows else []
+    return len(rows), audit_deleted(deleted)
+
+def cleanup(threshold_minutes: int, only_file_id: str|None=None, batch_size: int=BATCH_SIZE, mode: str="stream") -> int:
+    t0 = time.perf_counter()
+    n = _cleanup(threshold_minutes, only_file_id, max(1, min(batch_size, BATCH_SIZE)), mode)
+    metrics.JANITOR_SWEEP_SECONDS.observe(time.perf_counter() - t0)
+    metrics.JANITOR_LAST_SWEEP.set_to_current_time()
+    return n
+
+def _cleanup(threshold_minutes, only_file_id, batch_size, mode) -> int:
+    total = 0
+    if mode == "claim" and not only_file_id:
+        while True:
+            claimed, n = claim_batch(threshold_minutes, batch_size)
+            total += n
+            # leer oder nur Fehlschläge -> Sweep beenden statt dieselben Rows erneut zu claimen
+            if claimed < batch_size or n == 0: break
+        return total
+    for ids in iter_candidates(threshold_minutes, only_file_id, batch_size):
+        total += process_batch(ids, threshold_minutes, only_file_id)
+    return total
+
+# --- Verwaiste Multipart-Uploads ---
+# Nie abgeschlossene Multipart-Uploads belegen Speicher, ohne als Objekt sichtbar zu sein.
+def abort_stale_multipart(max_age_hours: int) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+    n = 0
+    for page in s3.get_paginator("list_multipart_uploads").paginate(Bucket=S3_BUCKET, Prefix="t-default/"):
+        for u in page.get("Uploads") or []:
+            if u["Initiated"] >= cutoff: continue
+            try:
+                s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=u["Key"], UploadId=u["UploadId"])
+                n += 1
+            except ClientError as e:
+                print(f"[warn] abort multipart failed for {u['Key']}: {e}")
+    return n
+
+# --- Audit-Retention ---
+def detach_audit(months: int) -> list:
+    """Hängt audit_log-Monatspartitionen älter als `months` ab (kein DELETE, kein Bloat)."""
+    with pool.cursor() as cur:
+        return audit.detach_before(cur, months)
+
+def maintenance(args):
+    """Seltene Aufgaben im Intervall --multipart-sweep-seconds."""
+    if args.multipart_stale_hours > 0:
+        m = abort_stale_multipart(args.multipart_stale_hours)
+        if m: print(f"[janitor] aborted {m} stale multipart upload(s)")
+    if args.audit_retention_months > 0:
+        for name in detach_audit(args.audit_retention_months):
+            print(f"[janitor] detached audit partition {name}")
+
+# --- Deadline-Scheduling ---
+# Statt fester Intervalle: bis zur nächsten Fälligkeit schlafen (partieller Index
+# file_object_expiry_idx), bei NOTIFY aus api2 früher aufwachen und neu rechnen.
+SCHEDULE_CHANNEL = "file_object_schedule"
+
+def next_deadline_s(threshold_minutes: int):
+    """Sekunden bis zur nächsten Fälligkeit (<=0: fällig), None: keine ephemeren Files."""
+    with pool.cursor() as cur:
         cur.execute("""
-          select id::text, s3_key
-          from file_object
-          where within_24h = true and server_received_at < now() - (%s)::interval
+          select extract(epoch from min(server_received_at) + (%s)::interval - now())
+          from file_object where within_24h
         """,(f"{threshold_minutes} minutes",))
-    rows = cur.fetchall()
-    total=0
-    for fid, key in rows:
-        try: s3.delete_object(Bucket=S3_BUCKET, Key=key)
-        except Exception as e: print(f"[warn] S3 delete failed for {key}: {e}")
-        cur2 = conn.cursor()
-        cur2.execute("delete from file_object where id=%s",(fid,))
-        cur2.execute("insert into audit_log(action, entity, entity_id, meta) values (%s,%s,%s,%s)",
-            ("files.cleanup","file_object",fid, psycopg2.extras.Json({"s3_key":key,"by":"janitor"})))
-        cur2.close()
-        total += 1
-    conn.commit(); cur.close(); conn.close()
-    return total
+        r = cur.fetchone()[0]
+    # Backlog-Alter: wie lange die älteste Row schon fällig ist
+    metrics.JANITOR_BACKLOG_AGE.set(0 if r is None else max(-float(r), 0))
+    return None if r is None else float(r)
+
+def listen():
+    """Eigene Autocommit-Connection (nicht aus dem Pool) für LISTEN."""
+    conn = psycopg2.connect(DB_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"listen {SCHEDULE_CHANNEL}")
+    return conn
+
+def wait_for_notify(conn, timeout: float) -> bool:
+    """Schläft bis timeout oder NOTIFY; True, wenn geweckt."""
+    if conn is None:
+        time.sleep(timeout); return False
+    if conn.notifies or select.select([conn], [], [], timeout) != ([], [], []):
+        conn.poll()
+        woke = bool(conn.notifies)
+        conn.notifies.clear()
+        return woke
+    return False
+
+def run_scheduled(args):
+    listener = None
+    next_mp = time.monotonic()
+    while True:
+        try:
+            if listener is None or listener.closed:
+                listener = listen()
+            if time.monotonic() >= next_mp:
+                next_mp = time.monotonic() + args.multipart_sweep_seconds
+                maintenance(args)
+            due = next_deadline_s(args.threshold_minutes)
+            if due is not None and due <= 0:
+                n = cleanup(args.threshold_minutes, batch_size=args.batch_size, mode=args.mode)
+                print(f"[janitor] cleaned {n} file(s)")
+                due = next_deadline_s(args.threshold_minutes)
+                metrics.write_textfile(args.metrics_textfile)
+                # immer noch fällig -> S3-Fehler o.ä.: nicht im Kreis drehen
+                if due is not None and due <= 0: due = args.retry_seconds
+            # knapp nach der Deadline aufwachen (Vergleich ist strikt '<')
+            sleep_s = args.interval_seconds if due is None else min(due + 0.05, args.interval_seconds)
+            if args.multipart_stale_hours > 0 or args.audit_retention_months > 0:
+                sleep_s = min(sleep_s, max(next_mp - time.monotonic(), 0))
+        except Exception as e:
+            print(f"[janitor] ERROR: {e}")
+            if listener is not None:
+                try: listener.close()
+                except Exception: pass
+            listener, sleep_s = None, args.retry_seconds
+        try:
+            wait_for_notify(listener, sleep_s)
+        except Exception as e:
+            print(f"[janitor] LISTEN lost: {e}")
+            listener = None
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--threshold-minutes", type=int, default=int(os.getenv("CLEANUP_THRESHOLD_MINUTES","1440")))
-    ap.add_argument("--interval-seconds", type=int, default=int(os.getenv("CLEANUP_INTERVAL_SECONDS","300")))
+    ap.add_argument("--interval-seconds", type=int, default=int(os.getenv("CLEANUP_INTERVAL_SECONDS","3600")),
+        help="max. Schlafdauer zwischen Deadline-Checks (Fallback, falls ein NOTIFY verloren geht)")
+    ap.add_argument("--retry-seconds", type=int, default=int(os.getenv("CLEANUP_RETRY_SECONDS","30")))
     ap.add_argument("--once", action="store_true")
     ap.add_argument("--only-file-id", type=str, default=None)
+    ap.add_argument("--batch-size", type=int, default=int(os.getenv("CLEANUP_BATCH_SIZE",str(BATCH_SIZE))))
+    ap.add_argument("--mode", choices=["stream","claim"], default=os.getenv("CLEANUP_MODE","stream"),
+        help="stream: ein Janitor, Server-Side-Cursor; claim: mehrere Replicas via SKIP LOCKED")
+    ap.add_argument("--multipart-stale-hours", type=int, default=int(os.getenv("MULTIPART_STALE_HOURS","24")),
+        help="unvollständige Multipart-Uploads älter als N Stunden abbrechen (0 = aus)")
+    ap.add_argument("--multipart-sweep-seconds", type=int, default=int(os.getenv("MULTIPART_SWEEP_SECONDS","3600")))
+    ap.add_argument("--audit-retention-months", type=int, default=int(os.getenv("AUDIT_RETENTION_MONTHS","0")),
+        help="audit_log-Partitionen älter als N Monate abhängen (0 = aus)")
+    ap.add_argument("--metrics-port", type=int, default=int(os.getenv("JANITOR_METRICS_PORT","0")),
+        help="Prometheus-Exporter auf diesem Port (0 = aus)")
+    ap.add_argument("--metrics-textfile", type=str, default=os.getenv("JANITOR_METRICS_TEXTFILE") or None,
+        help="Metriken nach jedem Lauf in diese .prom-Datei schreiben (node_exporter textfile collector)")
     args = ap.parse_args()
+    # SIGTERM (docker stop) -> normales Beenden, damit atexit den Audit-Puffer flusht
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    metrics.serve(args.metrics_port)
+    metrics.register_stats("db_pool", pool.stats)
 
     if args.once:
-        n=cleanup(args.threshold_minutes, args.only_file_id)
+        n=cleanup(args.threshold_minutes, args.only_file_id, args.batch_size, args.mode)
         print(f"[janitor] cleaned {n} file(s)")
+        if not args.only_file_id:
+            maintenance(args)
+            next_deadline_s(args.threshold_minutes)   # Backlog-Gauge für die Textfile-Ausgabe
+        audit.close()
+        metrics.write_textfile(args.metrics_textfile)
         return
 
-    while True:
-        try:
-            n=cleanup(args.threshold_minutes)
-            print(f"[janitor] cleaned {n} file(s)")
-        except Exception as e:
-            print(f"[janitor] ERROR: {e}")
-        time.sleep(args.interval_seconds)
+    run_scheduled(args)
 
 if __name__ == "__main__":
     main()
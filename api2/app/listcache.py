@@ -0,0 +1,189 @@
+"""Response-Cache für die Listings (/files/recent*), invalidiert per Versionszähler.
+
+Einträge hängen an (Version, Endpoint, limit, cursor) und enthalten den fertig
+serialisierten Body, den X-Next-Cursor und einen starken ETag.
+Jede Änderung an file_object erhöht die Version:
+  - im selben Prozess direkt nach dem Commit (bump()),
+  - in allen anderen Workern/Prozessen (Janitor, Verifier) per NOTIFY file_object_changed,
+    den listen() in einem Hintergrund-Thread empfängt.
+If-None-Match mit passendem ETag -> 304 ohne DB-Zugriff und ohne Signieren.
+
+ETag = Hash der Row-Daten (ohne presigned URLs, die sich bei jedem Signieren ändern)
+plus Zeitfenster (LIST_ETAG_WINDOW_S): nach Ablauf der TTL kostet ein unverändertes
+Listing eine Query, antwortet aber weiter 304 ohne Signieren und ohne Body. Das
+Zeitfenster sorgt dafür, dass ein Client die URLs seines Bodys nicht per 304 über
+ihre Gültigkeit hinaus weiterverwendet (Fenster < Ablaufzeit der URLs).
+
+Backend: In-Process-LRU (Default) oder Redis (LIST_CACHE_REDIS_URL), damit sich
+mehrere uvicorn-Worker Version und Einträge teilen. Die TTL (LIST_CACHE_TTL_S)
+begrenzt, wie alt die presigned URLs in einem gecachten Body höchstens sind.
+"""
+import json, time, select, hashlib, threading
+from collections import OrderedDict
+import psycopg2
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+REDIS_PREFIX = "api2:list:"
+
+
+def if_none_match(request: Request, etag) -> bool:
+    raw = request.headers.get("if-none-match") or ""
+    # schwacher Vergleich wie in RFC 9110 für If-None-Match vorgesehen; "*" passt auf
+    # jede vorhandene Repräsentation
+    tags = {t.strip().removeprefix("W/") for t in raw.split(",") if t.strip()}
+    return "*" in tags or etag in tags
+
+
+class _LocalBackend:
+    def __init__(self, size, ttl_s):
+        self.size = size
+        self.ttl_s = ttl_s
+        self._v = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self):
+        return self._v
+
+    def bump(self):
+        with self._lock:
+            self._v += 1
+            self._lru.clear()
+
+    def get(self, key):
+        with self._lock:
+            e = self._lru.get(key)
+            if e is None: return None
+            if e[0] < time.monotonic():
+                del self._lru[key]; return None
+            self._lru.move_to_end(key)
+            return e[1]
+
+    def put(self, key, entry):
+        with self._lock:
+            if key[0] != self._v: return   # während des Aufbaus invalidiert
+            self._lru[key] = (time.monotonic() + self.ttl_s, entry)
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+
+    def __len__(self):
+        return len(self._lru)
+
+
+class _RedisBackend:
+    def __init__(self, url, ttl_s):
+        import redis
+        self.r = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.ttl_s = ttl_s
+
+    def version(self):
+        return int(self.r.get(REDIS_PREFIX + "v") or 0)
+
+    def bump(self):
+        self.r.incr(REDIS_PREFIX + "v")
+
+    def _k(self, key):
+        return REDIS_PREFIX + ":".join(map(str, key))
+
+    def get(self, key):
+        raw = self.r.get(self._k(key))
+        if raw is None: return None
+        e = json.loads(raw)
+        return e["etag"], e["next"], e["body"].encode()
+
+    def put(self, key, entry):
+        etag, nxt, body = entry
+        self.r.set(self._k(key), json.dumps({"etag": etag, "next": nxt, "body": body.decode()}), ex=self.ttl_s)
+
+    def __len__(self):
+        return -1
+
+
+class ListCache:
+    def __init__(self, size=256, ttl_s=30, redis_url=None, etag_window_s=300):
+        self.enabled = size > 0 and ttl_s > 0
+        self.etag_window_s = max(1, etag_window_s)
+        self.backend = _RedisBackend(redis_url, ttl_s) if redis_url else _LocalBackend(size, ttl_s)
+        self.hits = self.misses = self.not_modified = self.errors = 0
+
+    def _safe(self, fn, *a):
+        # Redis-Ausfall darf Listings nicht brechen -> wie Cache-Miss behandeln
+        try: return fn(*a)
+        except Exception as e:
+            self.errors += 1
+            print(f"[list-cache] {e}")
+            return None
+
+    def bump(self):
+        if self.enabled: self._safe(self.backend.bump)
+
+    def lookup(self, request: Request, name, limit, cursor):
+        """-> (key, Response|None). key ist None, wenn nicht gecacht werden soll."""
+        if not self.enabled: return None, None
+        v = self._safe(self.backend.version)
+        if v is None: return None, None
+        key = (v, name, limit, cursor or "")
+        entry = self._safe(self.backend.get, key)
+        if entry is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        return key, self.respond(request, entry)
+
+    def etag(self, rows) -> str:
+        """Starker ETag aus den DB-Rows einer Seite (ohne URLs) + aktuellem Zeitfenster."""
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([tuple(r) for r in rows], default=str, separators=(",", ":")).encode())
+        h.update(b"|%d" % (int(time.time()) // self.etag_window_s))
+        return '"' + h.hexdigest() + '"'
+
+    def unchanged(self, request: Request, etag, response: Response):
+        """304, falls der Client diese Rows schon hat (vor dem Signieren prüfen) -> Response|None."""
+        if not if_none_match(request, etag): return None
+        return self.respond(request, (etag, response.headers.get("X-Next-Cursor"), b""))
+
+    def store(self, request: Request, key, content, response: Response, etag):
+        """Serialisiert content, legt den Eintrag unter key ab und antwortet mit etag (aus etag())."""
+        body = json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                          separators=(",", ":")).encode()
+        entry = (etag, response.headers.get("X-Next-Cursor"), body)
+        if key is not None: self._safe(self.backend.put, key, entry)
+        return self.respond(request, entry)
+
+    def respond(self, request: Request, entry):
+        etag, nxt, body = entry
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if nxt: headers["X-Next-Cursor"] = nxt
+        if if_none_match(request, etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+    def listen(self, dsn, channel, retry_s=5.0):
+        """Hintergrund-Thread: NOTIFY auf channel -> bump(). Nach Verbindungsverlust wird
+        ebenfalls invalidiert, weil Notifications verloren sein können."""
+        def run():
+            while True:
+                try:
+                    conn = psycopg2.connect(dsn); conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute(f"listen {channel}")
+                    self.bump()
+                    while True:
+                        if select.select([conn], [], [], 60) != ([], [], []):
+                            conn.poll()
+                            if conn.notifies:
+                                conn.notifies.clear(); self.bump()
+                except Exception as e:
+                    print(f"[list-cache] LISTEN lost: {e}")
+                    try: conn.close()
+                    except Exception: pass
+                    time.sleep(retry_s)
+        if self.enabled:
+            threading.Thread(target=run, name="list-cache-listen", daemon=True).start()
+
+    def stats(self):
+        return {"enabled": self.enabled, "backend": type(self.backend).__name__.strip("_"),
+                "size": len(self.backend) if self.enabled else 0, "hits": self.hits,
+                "misses": self.misses, "not_modified": self.not_modified, "errors": self.errors}
@@ -1,10 +1,16 @@
 import os, uuid, socket, time
+from contextlib import asynccontextmanager
 import psycopg2, psycopg2.extras
 import boto3
 from botocore.config import Config
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
+from app.pool import get_pool, PoolTimeout, numbered
+from app.presign import Presigner
+from app import verifier, audit, blobs, exif, thumbs, metrics, migrate
+from app.storage import S3Storage
+from app.listcache import ListCache
 
 DB_URL = os.getenv("DATABASE_URL")
 S3_ENDPOINT = os.getenv("S3_ENDPOINT")
@@ -14,54 +20,63 @@ S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
 S3_BUCKET = os.getenv("S3_BUCKET","artifacts")
 ALLOW_ORIGINS = (os.getenv("ALLOW_ORIGINS") or "*").split(",")
 
-app = FastAPI(title="Gatebook API2", version="0.1.0")
-app.add_middleware(CORSMiddleware, allow_origins=ALLOW_ORIGINS, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-
-def db(): return psycopg2.connect(DB_URL)
-def wait_db(max_tries=30, sleep_s=1.0):
-    last=None
-    for _ in range(max_tries):
-        try: c=db(); c.close(); return
-        except Exception as e: last=e; time.sleep(sleep_s)
-    raise last
-
-def ensure_schema():
-    wait_db()
-    conn=db(); cur=conn.cursor()
-    try: cur.execute("create extension if not exists pgcrypto;")
-    except Exception: pass
-    cur.execute("""
-    create table if not exists file_object(
-      id uuid primary key default gen_random_uuid(),
-      filename text not null,
-      size_bytes bigint,
-      content_type text,
-      s3_key text not null,
-      sha256_hex text,
-      server_received_at timestamptz not null default now(),
-      exif_taken_at timestamptz,
-      within_24h boolean not null default true
-    );""")
-    cur.execute("""
-    create table if not exists audit_log(
-      id bigserial primary key,
-      action text not null,
-      entity text not null,
-      entity_id uuid,
-      meta jsonb,
-      at timestamptz default now()
-    );""")
-    conn.commit(); cur.close(); conn.close()
-ensure_schema()
-
-s3_int=boto3.client("s3", endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=S3_ACCESS_KEY, aws_secret_access_key=S3_SECRET_KEY,
-    config=Config(s3={"addressing_style":"path"}, signature_version="s3v4"),
-    region_name="us-east-1")
-s3_pub=boto3.client("s3", endpoint_url=PUBLIC_S3_ENDPOINT,
-    aws_access_key_id=S3_ACCESS_KEY, aws_secret_access_key=S3_SECRET_KEY,
-    config=Config(s3={"addressing_style":"path"}, signature_version="s3v4"),
-    region_name="us-east-1")
+@asynccontextmanager
+async def lifespan(app):
+    """Start ohne DB-Zugriff und ohne DDL (Schema: python -m app.migrate); DB-Connections
+    entstehen beim ersten Request, /ready meldet, ab wann DB + Schema passen."""
+    init_clients()
+    list_cache.listen(DB_URL, CHANGED_CHANNEL)
+    if ASYNC_IO: await aio_start()
+    try:
+        yield
+    finally:
+        if ASYNC_IO: await aio_stop()
+        # Audit-Events gepuffert schreiben; Rest beim Shutdown synchron flushen
+        audit.close()
+
+app = FastAPI(title="Gatebook API2", version="0.1.0", lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=ALLOW_ORIGINS, allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "ETag"])
+# Latenz pro Route (äußerste Middleware -> inkl. CORS); Export unter GET /metrics
+if metrics.ENABLED: app.add_middleware(metrics.MetricsMiddleware)
+
+# Pool verbindet erst beim ersten Checkout
+pool = get_pool(dsn=DB_URL)
+
+# Janitor schläft bis zur nächsten Fälligkeit; Änderungen am Ablaufplan (neue
+# ephemere Files, Retention -> 24h) wecken ihn per NOTIFY. Zustellung erst beim Commit.
+SCHEDULE_CHANNEL = "file_object_schedule"
+NOTIFY_SQL = "select pg_notify(%s, '')"
+def notify_schedule(cur): cur.execute(NOTIFY_SQL, (SCHEDULE_CHANNEL,))
+
+# Listing-Cache (/files/recent*): jede Änderung an file_object erhöht die Version.
+# Im eigenen Prozess nach dem Commit per list_cache.bump(), andere Worker/Prozesse per NOTIFY.
+CHANGED_CHANNEL = "file_object_changed"
+def notify_changed(cur): cur.execute(NOTIFY_SQL, (CHANGED_CHANNEL,))
+list_cache = ListCache(size=int(os.getenv("LIST_CACHE_SIZE","256")),
+    ttl_s=int(os.getenv("LIST_CACHE_TTL_S","30")),
+    etag_window_s=int(os.getenv("LIST_ETAG_WINDOW_S","300")),
+    redis_url=os.getenv("LIST_CACHE_REDIS_URL") or None)
+
+# S3-Client und Presigner erst im Lifespan (nicht beim Import): Worker-Start und Reload
+# bleiben schnell, fehlende S3-Konfiguration bricht nicht schon den Import ab
+s3_int = storage = presigner = None
+
+def init_clients():
+    global s3_int, storage, presigner
+    s3_int=boto3.client("s3", endpoint_url=S3_ENDPOINT,
+        aws_access_key_id=S3_ACCESS_KEY, aws_secret_access_key=S3_SECRET_KEY,
+        config=Config(s3={"addressing_style":"path"}, signature_version="s3v4"),
+        region_name="us-east-1")
+    metrics.instrument_boto(s3_int)
+    storage=S3Storage(S3_BUCKET, S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY, client=s3_int)
+    # Presigned URLs lokal signieren (byte-identisch zu boto3, ohne Request-Pipeline)
+    presigner=Presigner(PUBLIC_S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY, S3_BUCKET,
+        region="us-east-1",
+        cache_size=int(os.getenv("PRESIGN_CACHE_SIZE","0")),
+        bucket_s=int(os.getenv("PRESIGN_CACHE_BUCKET_S","60")))
+
+def presign_stats():
+    return presigner.stats() if presigner is not None else {}
 
 class PreSignIn(BaseModel):
     filename: str
@@ -78,36 +93,95 @@ class ConfirmIn(BaseModel):
 @app.get("/health")
 def health(): return {"status":"ok","service":"api2"}
 
+# Readiness: DB erreichbar + Schema mindestens auf migrate.SCHEMA_VERSION. /health bleibt
+# reine Liveness ohne DB-Zugriff. Ergebnis READY_CACHE_S gecacht (Probes mehrerer Quellen).
+READY_CACHE_S = float(os.getenv("READY_CACHE_S","2"))
+_ready = {"at": float("-inf"), "state": None}
+
+def readiness():
+    if time.monotonic() - _ready["at"] < READY_CACHE_S: return _ready["state"]
+    prev = _ready["state"]
+    st = {"ready": False, "schema_version": None, "expected_schema_version": migrate.SCHEMA_VERSION}
+    try:
+        with pool.cursor(timeout=1.0) as cur:
+            st["schema_version"] = migrate.current_version(cur)
+        st["ready"] = s3_int is not None and st["schema_version"] >= migrate.SCHEMA_VERSION
+        if st["schema_version"] < migrate.SCHEMA_VERSION: st["error"] = "schema behind: run python -m app.migrate"
+    except PoolTimeout:
+        # Pool ausgelastet heißt nicht "nicht bereit" -> letzten Stand behalten
+        if prev is not None: return prev
+        st["error"] = "db pool busy"
+    except Exception as e:
+        st["error"] = f"{type(e).__name__}: {e}".strip()[:200]
+    if prev is None or prev["ready"] != st["ready"]:
+        print(f"[api2] ready={st['ready']} {st.get('error', '')}")
+    _ready.update(at=time.monotonic(), state=st)
+    return st
+
+@app.get("/ready")
+def ready(response: Response):
+    st = readiness()
+    if not st["ready"]: response.status_code = 503
+    return st
+
+@app.get("/health/db-pool")
+def health_db_pool(): return pool.stats()
+
+@app.get("/health/presign-cache")
+def health_presign_cache(): return presign_stats()
+
+@app.get("/health/audit")
+def health_audit(): return audit.stats()
+
+@app.get("/health/list-cache")
+def health_list_cache(): return list_cache.stats()
+
+# Prometheus: Histogramme (HTTP, S3, DB) + beim Scrape gelesene Stats der Komponenten
+metrics.register_stats("db_pool", pool.stats)
+metrics.register_stats("presign_cache", presign_stats)
+metrics.register_stats("audit", audit.stats)
+metrics.register_stats("list_cache", list_cache.stats)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    body, ctype = metrics.render()
+    return Response(body, media_type=ctype)
+
 @app.post("/files/presign", response_model=PreSignOut)
 def files_presign(inp:PreSignIn):
     file_id=str(uuid.uuid4()); s3_key=f"t-default/{file_id}/{inp.filename}"
-    url=s3_pub.generate_presigned_url("put_object",
-        Params={"Bucket":S3_BUCKET,"Key":s3_key,"ContentType":inp.content_type}, ExpiresIn=900)
-    conn=db(); cur=conn.cursor()
-    cur.execute("insert into file_object(id, filename, content_type, s3_key, within_24h) values (%s,%s,%s,%s,true)",
-        (file_id, inp.filename, inp.content_type, s3_key))
-    cur.execute("insert into audit_log(action, entity, entity_id, meta) values (%s,%s,%s,%s)",
-        ("files.presign","file_object",file_id, psycopg2.extras.Json({"filename":inp.filename})))
-    conn.commit(); cur.close(); conn.close()
+    url=presigner.put_url(s3_key, inp.content_type, expires=900)
+    with pool.cursor() as cur:
+        cur.execute("insert into file_object(id, filename, content_type, s3_key, within_24h) values (%s,%s,%s,%s,true)",
+            (file_id, inp.filename, inp.content_type, s3_key))
+        notify_schedule(cur); notify_changed(cur)
+    list_cache.bump()
+    audit.log("files.presign","file_object",file_id,{"filename":inp.filename})
     return {"file_id":file_id,"s3_key":s3_key,"url":url}
 
 @app.post("/files/confirm")
 def files_confirm(inp:ConfirmIn):
-    conn=db(); cur=conn.cursor(); cur.execute("select s3_key from file_object where id=%s",(inp.file_id,)); row=cur.fetchone(); cur.close(); conn.close()
-    if not row: return {"ok":False,"error":"file_id unbekannt"}
-    key=row[0]
-    head=s3_int.head_object(Bucket=S3_BUCKET, Key=key)
-    size_bytes=head.get("ContentLength"); content_type=head.get("ContentType","application/octet-stream")
-    conn=db(); cur=conn.cursor()
-    cur.execute("update file_object set size_bytes=%s, content_type=%s, sha256_hex=%s, server_received_at=now() where id=%s",
-        (size_bytes,content_type,inp.sha256_hex,inp.file_id))
-    cur.execute("insert into audit_log(action, entity, entity_id, meta) values (%s,%s,%s,%s)",
-        ("files.confirm","file_object",inp.file_id, psycopg2.extras.Json({"size":size_bytes})))
-    conn.commit(); cur.close(); conn.close()
+    # eine Connection für Lookup + Update; HEAD läuft dazwischen ohne offene Transaktion
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("select s3_key from file_object where id=%s",(inp.file_id,)); row=cur.fetchone()
+        if not row: return {"ok":False,"error":"file_id unbekannt"}
+        conn.commit()
+        key=row[0]
+        head=s3_int.head_object(Bucket=S3_BUCKET, Key=key)
+        size_bytes=head.get("ContentLength"); content_type=head.get("ContentType","application/octet-stream")
+        cur.execute("update file_object set size_bytes=%s, content_type=%s, sha256_hex=%s, server_received_at=now() where id=%s",
+            (size_bytes,content_type,inp.sha256_hex,inp.file_id))
+        exif.enqueue_many(cur, [(inp.file_id, key, size_bytes or 0, content_type)])
+        thumbs.enqueue_many(cur, [(inp.file_id, key, size_bytes or 0, content_type)])
+        notify_schedule(cur); notify_changed(cur)
+    list_cache.bump()
+    audit.log("files.confirm","file_object",inp.file_id,{"size":size_bytes})
     return {"ok":True,"size_bytes":size_bytes,"content_type":content_type}
+import base64
 from typing import List, Optional
 from datetime import datetime
 from pydantic import BaseModel
+from fastapi import HTTPException
 
 class FileRowOut(BaseModel):
     id: str
@@ -117,68 +191,120 @@ class FileRowOut(BaseModel):
     s3_key: str
     server_received_at: Optional[datetime] = None
     get_url: Optional[str] = None
+    thumb_url: Optional[str] = None
 
 def make_get_url(key: str, expires=900) -> str:
-    return s3_pub.generate_presigned_url(
-        "get_object",
-        Params={"Bucket": S3_BUCKET, "Key": key},
-        ExpiresIn=expires
-    )
+    return presigner.get_url(key, expires)
+
+def make_get_urls(keys: List[str], expires=900) -> List[Optional[str]]:
+    """Bulk-Variante für Listings: ein Signing-Durchlauf, leere Keys -> None."""
+    urls = iter(presigner.get_urls([k for k in keys if k], expires))
+    return [next(urls) if k else None for k in keys]
+
+# --- Keyset-Pagination für /files/recent* ---
+# Sortierung (server_received_at desc nulls last, id desc) deckt sich mit
+# file_object_recent_idx; der Cursor ist opak (base64url von "ts|id") und kommt
+# im Header X-Next-Cursor zurück, der Body bleibt eine Liste.
+PAGE_MAX = int(os.getenv("LIST_PAGE_MAX","200"))
+# Hash-Mismatch (Verifier): Objekt liegt in Quarantäne -> nicht listen, exportieren, ausliefern
+VISIBLE = "verify_state is distinct from 'mismatch'"
+
+def encode_cursor(ts: datetime, fid: str) -> str:
+    return base64.urlsafe_b64encode(f"{ts.isoformat()}|{fid}".encode()).decode().rstrip("=")
+
+def decode_cursor(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        ts, fid = raw.split("|", 1)
+        return datetime.fromisoformat(ts), str(uuid.UUID(fid))
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+def keyset_query(cols: str, limit: int, cursor: Optional[str]):
+    """-> (sql, params, limit); holt limit+1 Zeilen, um eine Folgeseite zu erkennen.
+    Async-Modus: numbered(sql)."""
+    limit = max(1, min(limit, PAGE_MAX))
+    where, params = f"where {VISIBLE} ", []
+    if cursor:
+        # server_received_at ist NOT NULL -> Row-Vergleich reicht und nutzt den Index
+        where += "and (server_received_at, id) < (%s, %s::uuid) "
+        params = list(decode_cursor(cursor))
+    sql = (f"select {cols} from file_object {where}"
+           "order by server_received_at desc nulls last, id desc limit %s")
+    return sql, params + [limit + 1], limit
+
+def keyset_page(rows, limit: int, response: Response):
+    """Schneidet die Zusatzzeile ab und setzt X-Next-Cursor (Spalten: id, …, s3_key, ts)."""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1][5], rows[-1][0])
+    return rows
 
 @app.get("/files/recent", response_model=List[FileRowOut])
-def files_recent(limit: int = 20):
-    conn=db(); cur=conn.cursor()
-    cur.execute(
-        "select id::text, filename, size_bytes, content_type, s3_key, server_received_at "
-        "from file_object order by server_received_at desc nulls last limit %s",
-        (limit,)
-    )
+def files_recent(request: Request, response: Response, limit: int = 20, cursor: Optional[str] = None):
+    ck, hit = list_cache.lookup(request, "recent", limit, cursor)
+    if hit: return hit
+    sql, params, limit = keyset_query(
+        "id::text, filename, size_bytes, content_type, s3_key, server_received_at, thumb_key", limit, cursor)
+    with pool.cursor() as cur:
+        cur.execute(sql, params)
+        fetched=keyset_page(cur.fetchall(), limit, response)
+    etag=list_cache.etag(fetched)
+    nm=list_cache.unchanged(request, etag, response)
+    if nm: return nm
     rows=[]
-    for rid,fn,sz,ct,key,dt in cur.fetchall():
-        url = make_get_url(key) if key else None
+    urls=make_get_urls([r[4] for r in fetched] + [r[6] for r in fetched])
+    for (rid,fn,sz,ct,key,dt,_),url,turl in zip(fetched,urls,urls[len(fetched):]):
         rows.append({
             "id":rid,"filename":fn,"size_bytes":sz,"content_type":ct,
-            "s3_key":key,"server_received_at":dt,"get_url":url
+            "s3_key":key,"server_received_at":dt,"get_url":url,"thumb_url":turl
         })
-    cur.close(); conn.close()
-    return rows
+    return list_cache.store(request, ck, [FileRowOut(**r) for r in rows], response, etag)
 
 @app.get("/files/{file_id}/download", response_model=FileRowOut)
 def files_download(file_id: str):
-    conn=db(); cur=conn.cursor()
-    cur.execute(
-        "select id::text, filename, size_bytes, content_type, s3_key, server_received_at "
-        "from file_object where id=%s",
-        (file_id,)
-    )
-    r = cur.fetchone(); cur.close(); conn.close()
+    with pool.cursor() as cur:
+        cur.execute(
+            "select id::text, filename, size_bytes, content_type, s3_key, server_received_at, verify_state "
+            "from file_object where id=%s",
+            (file_id,)
+        )
+        r = cur.fetchone()
     if not r:
         return {"id":file_id,"filename":"(not found)","s3_key":"","get_url":None}
-    rid,fn,sz,ct,key,dt = r
+    rid,fn,sz,ct,key,dt,vs = r
+    if vs == "mismatch":
+        raise HTTPException(status_code=409, detail="file failed sha256 verification")
     return {"id":rid,"filename":fn,"size_bytes":sz,"content_type":ct,"s3_key":key,"server_received_at":dt,"get_url":make_get_url(key)}
 from typing import Dict
 
+# SQL-Texte, die Sync-Handler (psycopg2) und Async-Handler (asyncpg, numbered) teilen
+FILE_KEY_SQL = "select s3_key from file_object where id=%s"
+FILE_DELETE_SQL = "delete from file_object where id=%s"
+
 @app.delete("/files/{file_id}")
 def files_delete(file_id: str) -> Dict[str, bool]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("select s3_key from file_object where id=%s",(file_id,))
-    r = cur.fetchone()
-    if not r:
-        cur.close(); conn.close()
-        return {"ok": False}
-    key = r[0]
-    # S3: best effort entfernen
-    try:
-        s3_int.delete_object(Bucket=S3_BUCKET, Key=key)
-    except Exception:
-        pass
-    # DB-Row löschen + Audit
-    cur.execute("delete from file_object where id=%s",(file_id,))
-    cur.execute(
-      "insert into audit_log(action, entity, entity_id, meta) values (%s,%s,%s,%s)",
-      ("files.delete","file_object",file_id, psycopg2.extras.Json({"s3_key":key}))
-    )
-    conn.commit(); cur.close(); conn.close()
+    file_id = known_file_id(file_id)
+    with pool.cursor() as cur:
+        cur.execute(FILE_KEY_SQL,(file_id,))
+        r = cur.fetchone()
+        if not r:
+            return {"ok": False}
+        key = r[0]
+        # S3: best effort entfernen – außer der Blob wird noch von anderen Rows referenziert
+        if key not in blobs.shared_keys(cur, [key]):
+            try:
+                # Original + Rendition (Thumbnail) in einem Call
+                s3_int.delete_objects(Bucket=S3_BUCKET, Delete={"Quiet": True,
+                    "Objects": [{"Key": key}, {"Key": thumbs.thumb_key(key)}]})
+            except Exception:
+                pass
+        # DB-Row löschen
+        cur.execute(FILE_DELETE_SQL,(file_id,))
+        blobs.drop_refs(cur, [key])
+        notify_changed(cur)
+    list_cache.bump()
+    audit.log("files.delete","file_object",file_id,{"s3_key":key})
     return {"ok": True}
 from typing import Dict, List, Optional
 from datetime import datetime
@@ -187,43 +313,49 @@ class RetentionIn(BaseModel):
     within_24h: bool
 
 @app.get("/files/recent2")
-def files_recent2(limit: int = 20):
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      select id::text, filename, size_bytes, content_type, s3_key, server_received_at, within_24h
-      from file_object order by server_received_at desc nulls last limit %s
-    """,(limit,))
+def files_recent2(request: Request, response: Response, limit: int = 20, cursor: Optional[str] = None):
+    ck, hit = list_cache.lookup(request, "recent2", limit, cursor)
+    if hit: return hit
+    sql, params, limit = keyset_query(
+        "id::text, filename, size_bytes, content_type, s3_key, server_received_at, within_24h, thumb_key", limit, cursor)
+    with pool.cursor() as cur:
+        cur.execute(sql, params)
+        fetched=keyset_page(cur.fetchall(), limit, response)
+    etag=list_cache.etag(fetched)
+    nm=list_cache.unchanged(request, etag, response)
+    if nm: return nm
     out=[]
-    for rid,fn,sz,ct,key,dt,w24 in cur.fetchall():
-        url = make_get_url(key) if key else None
+    # Originale + Thumbnails in einem Signing-Durchlauf
+    urls=make_get_urls([r[4] for r in fetched] + [r[7] for r in fetched])
+    for (rid,fn,sz,ct,key,dt,w24,_),url,turl in zip(fetched,urls,urls[len(fetched):]):
         out.append({
             "id":rid,"filename":fn,"size_bytes":sz,"content_type":ct,
-            "s3_key":key,"server_received_at":dt,"get_url":url,"within_24h":w24
+            "s3_key":key,"server_received_at":dt,"get_url":url,"within_24h":w24,"thumb_url":turl
         })
-    cur.close(); conn.close()
-    return out
+    return list_cache.store(request, ck, out, response, etag)
+
+RETENTION_SQL = ("update file_object set within_24h=%s where id=%s "
+    "returning id::text, filename, size_bytes, content_type, s3_key, server_received_at, within_24h, verify_state")
 
 @app.patch("/files/{file_id}/retention")
 def files_set_retention(file_id: str, inp: RetentionIn):
-    conn=db(); cur=conn.cursor()
-    cur.execute(
-      "update file_object set within_24h=%s where id=%s "
-      "returning id::text, filename, size_bytes, content_type, s3_key, server_received_at, within_24h",
-      (inp.within_24h, file_id)
-    )
-    r = cur.fetchone(); conn.commit(); cur.close(); conn.close()
+    with pool.cursor() as cur:
+        cur.execute(RETENTION_SQL, (inp.within_24h, file_id))
+        r = cur.fetchone()
+        if r and inp.within_24h: notify_schedule(cur)
+        if r: notify_changed(cur)
     if not r: return {"ok": False}
-    rid,fn,sz,ct,key,dt,w24 = r
+    list_cache.bump()
+    rid,fn,sz,ct,key,dt,w24,vs = r
     return {
       "ok": True,
       "id": rid, "filename": fn, "size_bytes": sz, "content_type": ct,
-      "s3_key": key, "server_received_at": dt, "get_url": make_get_url(key),
+      "s3_key": key, "server_received_at": dt, "get_url": None if vs == "mismatch" else make_get_url(key),
       "within_24h": w24
     }
 # --- Upload-Validierung & neue Endpoints (presign2/confirm2) ---
-import os, re, uuid, hashlib
+import os, re, uuid
 from typing import Optional
-from fastapi import HTTPException
 
 ALLOWED_MIME = set(x.strip() for x in os.getenv("UPLOAD_ALLOWED_MIME","image/png,image/jpeg,image/webp,application/pdf,text/plain,application/zip").split(",") if x.strip())
 MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES","10485760"))
@@ -234,11 +366,11 @@ def sanitize_filename(fn: str) -> str:
     fn = re.sub(r"[^A-Za-z0-9._ -]", "_", fn)[:128]
     return fn or "file"
 
-def validate_upload_meta(filename: str, content_type: str, size_bytes: int):
+def validate_upload_meta(filename: str, content_type: str, size_bytes: int, max_bytes: int = MAX_BYTES):
     if not filename or "/" in filename or "\\" in filename or filename.strip()=="":
         raise HTTPException(status_code=400, detail="invalid filename")
-    if size_bytes <= 0 or size_bytes > MAX_BYTES:
-        raise HTTPException(status_code=400, detail=f"file too large (max {MAX_BYTES} bytes)")
+    if size_bytes <= 0 or size_bytes > max_bytes:
+        raise HTTPException(status_code=400, detail=f"file too large (max {max_bytes} bytes)")
     if content_type not in ALLOWED_MIME:
         raise HTTPException(status_code=415, detail=f"content_type not allowed: {content_type}")
 
@@ -246,71 +378,612 @@ class Presign2In(BaseModel):
     filename: str
     content_type: str
     size_bytes: int
+    sha256_hex: Optional[str] = None   # nur für Dedup (UPLOAD_DEDUP)
 
 class Presign2Out(BaseModel):
     file_id: str
     s3_key: str
-    url: str
+    url: Optional[str] = None          # None bei deduplicated -> kein PUT/confirm2 nötig
+    deduplicated: bool = False
 
-@app.post("/files/presign2", response_model=Presign2Out)
-def presign2(inp: Presign2In):
+# Pending-Upload-Registry: presign2 merkt sich Key + deklarierte Metadaten, damit
+# confirm2 ohne LIST direkt per HEAD prüfen kann. Abgelaufene Einträge räumt jeder
+# presign2 häppchenweise mit weg (Index auf expires_at, kein Janitor-Scan).
+PRESIGN_EXPIRES = 900
+PENDING_GRACE_S = int(os.getenv("PENDING_UPLOAD_GRACE_S","3600"))
+PENDING_TTL_S = PRESIGN_EXPIRES + PENDING_GRACE_S
+PENDING_PRUNE = """
+  delete from pending_upload where file_id in (
+    select file_id from pending_upload where expires_at < now() limit 100 for update skip locked)"""
+PENDING_INSERT = ("insert into pending_upload(file_id, s3_key, size_bytes, content_type, expires_at) "
+                  "values (%s,%s,%s,%s, now() + make_interval(secs => %s))")
+PENDING_LOOKUP = ("select s3_key, size_bytes, content_type from pending_upload "
+                  "where file_id=%s and expires_at > now()")
+PENDING_DONE = "delete from pending_upload where file_id=%s"
+
+# file_object-Row nach erfolgreichem Upload (confirm2, Batch, Multipart); Batch mit VALUES %s
+FILE_UPSERT_COLS = ("insert into file_object(id, filename, size_bytes, content_type, s3_key, "
+                    "server_received_at, within_24h, sha256_hex, verify_state)")
+FILE_UPSERT_CONFLICT = """
+  on conflict (id) do update
+    set filename=excluded.filename,
+        size_bytes=excluded.size_bytes,
+        content_type=excluded.content_type,
+        s3_key=excluded.s3_key,
+        server_received_at=excluded.server_received_at,
+        sha256_hex=excluded.sha256_hex,
+        verify_state=excluded.verify_state"""
+FILE_UPSERT = FILE_UPSERT_COLS + " values (%s,%s,%s,%s,%s, now(), true, %s, %s)" + FILE_UPSERT_CONFLICT
+FILE_UPSERT_MANY = FILE_UPSERT_COLS + " values %s" + FILE_UPSERT_CONFLICT
+DEDUP_INSERT = FILE_UPSERT_COLS + " values (%s,%s,%s,%s,%s, now(), true, %s, 'ok')"
+
+def upload_key(inp: Presign2In):
+    """-> (file_id, key) für einen validierten Upload (HTTPException bei ungültigen Metadaten)."""
     validate_upload_meta(inp.filename, inp.content_type, inp.size_bytes)
     file_id = str(uuid.uuid4())
-    safe = sanitize_filename(inp.filename)
-    key = f"t-default/{file_id}/{safe}"
+    return file_id, f"t-default/{file_id}/{sanitize_filename(inp.filename)}"
+
+# Dedup (UPLOAD_DEDUP=true): schickt der Client den Hash schon beim presign und gibt es
+# einen verifizierten Blob mit gleichem Hash/Größe/Typ, entfällt der Upload komplett –
+# neue file_object-Row auf den vorhandenen s3_key, refcount + 1. Scope: ein Tenant (t-default).
+DEDUP = os.getenv("UPLOAD_DEDUP","false").lower() in ("1","true","yes")
+
+def dedup_sha_of(inp: Presign2In) -> Optional[str]:
+    if not (DEDUP and inp.sha256_hex): return None
+    sha = inp.sha256_hex.strip().lower()
+    if not SHA256_RE.match(sha):
+        raise HTTPException(status_code=400, detail="invalid sha256_hex")
+    return sha
+
+def dedup_row(cur, file_id: str, inp: Presign2In, sha: str) -> Optional[str]:
+    """Referenz auf vorhandenen Blob + neue file_object-Row -> geteilter s3_key oder None."""
+    key = blobs.acquire(cur, sha, inp.size_bytes, inp.content_type)
+    if key is None: return None
+    cur.execute(DEDUP_INSERT, (file_id, sanitize_filename(inp.filename), inp.size_bytes, inp.content_type, key, sha))
+    # Rendition des Blobs existiert meist schon -> Worker setzt nur thumb_key
+    thumbs.enqueue_many(cur, [(file_id, key, inp.size_bytes, inp.content_type)])
+    return key
+
+@app.post("/files/presign2", response_model=Presign2Out)
+def presign2(inp: Presign2In):
+    file_id, key = upload_key(inp)
+    sha = dedup_sha_of(inp)
+    with pool.cursor() as cur:
+        shared = dedup_row(cur, file_id, inp, sha) if sha else None
+        if shared:
+            notify_schedule(cur); notify_changed(cur)
+        else:
+            cur.execute(PENDING_PRUNE)
+            cur.execute(PENDING_INSERT, (file_id, key, inp.size_bytes, inp.content_type, PENDING_TTL_S))
+    if shared:
+        list_cache.bump()
+        audit.log("files.dedup","file_object",file_id,{"s3_key":shared,"sha256":sha})
+        return {"file_id": file_id, "s3_key": shared, "url": None, "deduplicated": True}
     # ContentType wird mit-signiert -> muss der Browser beim PUT mitsenden
-    url = s3_pub.generate_presigned_url("put_object",
-        Params={"Bucket": S3_BUCKET, "Key": key, "ContentType": inp.content_type},
-        ExpiresIn=900)
+    url = presigner.put_url(key, inp.content_type, expires=PRESIGN_EXPIRES)
     return {"file_id": file_id, "s3_key": key, "url": url}
 
+def check_uploaded(head, pending, max_bytes: int = MAX_BYTES):
+    """Größe/Typ gegen Limits und (falls vorhanden) die presign-Deklaration prüfen."""
+    size = head["size"]; ctype = head["content_type"] or "application/octet-stream"
+    if size <= 0 or size > max_bytes:
+        return "uploaded object invalid size"
+    if pending and (size != pending[1] or ctype != pending[2]):
+        return "uploaded object does not match presign"
+    return None
+
 class Confirm2In(BaseModel):
     file_id: str
     sha256_hex: Optional[str] = None
 
+def known_file_id(file_id: str) -> str:
+    """Kein UUID -> kann es nicht geben: 404 statt Postgres-Fehler (500)."""
+    try: return str(uuid.UUID(file_id))
+    except ValueError: raise HTTPException(status_code=404, detail="file not found")
+
 @app.post("/files/confirm2")
 def confirm2(inp: Confirm2In):
-    fid = inp.file_id
-    prefix = f"t-default/{fid}/"
-    # key herausfinden (wir kennen nur die ID)
-    res = s3_int.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix, MaxKeys=1)
-    if "Contents" not in res or not res["Contents"]:
-        raise HTTPException(status_code=404, detail="object not found in S3")
-    key = res["Contents"][0]["Key"]
+    return confirm_upload(known_file_id(inp.file_id), inp.sha256_hex)
 
-    head = s3_int.head_object(Bucket=S3_BUCKET, Key=key)
-    size = int(head.get("ContentLength", 0) or 0)
-    ctype = head.get("ContentType") or "application/octet-stream"
+def confirm_upload(fid: str, sha256_hex: Optional[str], max_bytes: int = MAX_BYTES, pending=None):
+    """HEAD + Prüfung + file_object-Row; pending = (key, size, content_type) falls schon gelesen."""
+    if pending is None:
+        with pool.cursor() as cur:
+            cur.execute(PENDING_LOOKUP, (fid,))
+            pending = cur.fetchone()
+    # Fallback ohne Registry-Eintrag (alte Presigns, Registry nach Crash leer): key per LIST
+    key = pending[0] if pending else storage.first_key(f"t-default/{fid}/")
+    head = storage.head(key) if key else None
+    if not head:
+        raise HTTPException(status_code=404, detail="object not found in S3")
+    size = head["size"]; ctype = head["content_type"] or "application/octet-stream"
 
-    if size <= 0 or size > MAX_BYTES:
-        try: s3_int.delete_object(Bucket=S3_BUCKET, Key=key)
+    err = check_uploaded(head, pending, max_bytes)
+    if err:
+        try: storage.delete(key)
         except Exception: pass
-        raise HTTPException(status_code=400, detail="uploaded object invalid size")
+        raise HTTPException(status_code=400, detail=err)
+
+    # Hash-Prüfung läuft asynchron im Verifier (python -m app.verifier)
+    verify = verify_sha_of(sha256_hex)
+    state = "pending" if verify else None
+    filename = key.split("/", 2)[-1]
+    with pool.cursor() as cur:
+        cur.execute(FILE_UPSERT, (fid, filename, size, ctype, key, verify, state))
+        if verify: verifier.enqueue(cur, fid, key, size, verify)
+        exif.enqueue_many(cur, [(fid, key, size, ctype)])
+        thumbs.enqueue_many(cur, [(fid, key, size, ctype)])
+        cur.execute(PENDING_DONE, (fid,))
+        notify_schedule(cur); notify_changed(cur)
+    list_cache.bump()
+    audit.log("files.confirm","file_object",fid,{"size":size})
+    return {"ok": True, "size_bytes": size, "content_type": ctype, "verification": state or "skipped"}
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+def verify_sha_of(sha256_hex: Optional[str]) -> Optional[str]:
+    """Normalisierter Soll-Hash, wenn verifiziert werden soll; sonst None."""
+    if not (VERIFY_SHA256 and sha256_hex): return None
+    sha = sha256_hex.strip().lower()
+    if not SHA256_RE.match(sha):
+        raise HTTPException(status_code=400, detail="invalid sha256_hex")
+    return sha
+
+@app.get("/files/{file_id}/verification")
+def files_verification(file_id: str):
+    file_id = known_file_id(file_id)
+    with pool.cursor() as cur:
+        cur.execute("""
+          select f.verify_state, f.sha256_hex, j.attempts
+          from file_object f left join verify_job j on j.file_id=f.id where f.id=%s
+        """, (file_id,))
+        r = cur.fetchone()
+    if not r: raise HTTPException(status_code=404, detail="file not found")
+    return {"file_id": file_id, "state": r[0] or "skipped", "sha256_hex": r[1], "attempts": r[2] or 0}
+# --- /Upload-Validierung ---
+
+# --- Batch-Endpoints (Ordner-Uploads) ---
+# N Dateien pro Call: Validierung pro Datei, alle PUT-URLs in einem Signing-Durchlauf,
+# HEADs parallel, DB-Rows/Audit als Multi-Row-Statements; Ergebnis pro Datei in
+# Eingabereihenfolge ({"ok": false, "status", "error"} statt Abbruch des Batches).
+from concurrent.futures import ThreadPoolExecutor
+
+BATCH_MAX = int(os.getenv("UPLOAD_BATCH_MAX","500"))
+HEAD_CONCURRENCY = int(os.getenv("CONFIRM_HEAD_CONCURRENCY","16"))
+s3_workers = ThreadPoolExecutor(HEAD_CONCURRENCY, thread_name_prefix="s3-batch")
+
+class Presign2BatchIn(BaseModel):
+    files: List[Presign2In] = Field(min_length=1, max_length=BATCH_MAX)
+
+class Confirm2BatchIn(BaseModel):
+    files: List[Confirm2In] = Field(min_length=1, max_length=BATCH_MAX)
+
+def batch_error(status: int, error: str):
+    return {"ok": False, "status": status, "error": error}
 
-    if VERIFY_SHA256 and inp.sha256_hex:
-        body = s3_int.get_object(Bucket=S3_BUCKET, Key=key)["Body"]
-        h = hashlib.sha256()
+@app.post("/files/presign2/batch")
+def presign2_batch(inp: Presign2BatchIn):
+    results, valid = [], []
+    for f in inp.files:
+        try:
+            file_id, key = upload_key(f)
+            valid.append((len(results), f, file_id, key, dedup_sha_of(f)))
+        except HTTPException as e:
+            results.append(batch_error(e.status_code, e.detail)); continue
+        results.append({"ok": True, "file_id": file_id, "s3_key": key})
+    if not valid: return {"results": results}
+    signable, rows, events = [], [], []
+    with pool.cursor() as cur:
+        for i, f, file_id, key, sha in valid:
+            shared = dedup_row(cur, file_id, f, sha) if sha else None
+            if shared:
+                results[i].update(s3_key=shared, url=None, deduplicated=True)
+                events.append(("files.dedup", "file_object", file_id, {"s3_key": shared, "sha256": sha}))
+            else:
+                signable.append((i, key, f.content_type))
+                rows.append((file_id, key, f.size_bytes, f.content_type, PENDING_TTL_S))
+        if events:
+            notify_schedule(cur); notify_changed(cur)
+        if rows:
+            cur.execute(PENDING_PRUNE)
+            psycopg2.extras.execute_values(cur,
+                "insert into pending_upload(file_id, s3_key, size_bytes, content_type, expires_at) values %s",
+                rows, template="(%s::uuid,%s,%s,%s, now() + make_interval(secs => %s))", page_size=BATCH_MAX)
+    if events:
+        list_cache.bump(); audit.log_many(events)
+    urls = presigner.put_urls([(k, ct) for _, k, ct in signable], expires=PRESIGN_EXPIRES)
+    for (i, _, _), url in zip(signable, urls):
+        results[i]["url"] = url
+    return {"results": results}
+
+def probe_upload(fid: str, pending):
+    """-> (key, head) bzw. Exception; läuft parallel im s3_workers-Pool."""
+    try:
+        key = pending[0] if pending else storage.first_key(f"t-default/{fid}/")
+        return key, (storage.head(key) if key else None)
+    except Exception as e:
+        return None, e
+
+def try_delete(key: str):
+    try: storage.delete(key)
+    except Exception: pass
+
+@app.post("/files/confirm2/batch")
+def confirm2_batch(inp: Confirm2BatchIn):
+    results = [None] * len(inp.files)
+    todo, seen = [], set()
+    for i, f in enumerate(inp.files):
+        try: fid = known_file_id(f.file_id)
+        except HTTPException as e:
+            results[i] = batch_error(e.status_code, e.detail); continue
+        if fid in seen:
+            results[i] = batch_error(400, "duplicate file_id in batch"); continue
+        seen.add(fid); todo.append((i, fid))
+    if not todo: return {"results": results}
+
+    with pool.cursor() as cur:
+        cur.execute("select file_id::text, s3_key, size_bytes, content_type from pending_upload "
+                    "where file_id = any(%s::uuid[]) and expires_at > now()", ([fid for _, fid in todo],))
+        pending = {r[0]: r[1:] for r in cur.fetchall()}
+    probes = s3_workers.map(lambda t: probe_upload(t[1], pending.get(t[1])), todo)
+
+    rows, jobs, events, bad_keys = [], [], [], []
+    for (i, fid), (key, head) in zip(todo, probes):
+        if isinstance(head, Exception):
+            results[i] = batch_error(502, f"storage error: {head}"); continue
+        if not head:
+            results[i] = batch_error(404, "object not found in S3"); continue
+        err = check_uploaded(head, pending.get(fid))
+        if err:
+            bad_keys.append(key); results[i] = batch_error(400, err); continue
+        try: verify = verify_sha_of(inp.files[i].sha256_hex)
+        except HTTPException as e:
+            results[i] = batch_error(e.status_code, e.detail); continue
+        size = head["size"]; ctype = head["content_type"] or "application/octet-stream"
+        state = "pending" if verify else None
+        rows.append((fid, key.split("/", 2)[-1], size, ctype, key, verify, state))
+        if verify: jobs.append((fid, key, size, verify))
+        events.append(("files.confirm", "file_object", fid, {"size": size, "batch": True}))
+        results[i] = {"ok": True, "file_id": fid, "size_bytes": size, "content_type": ctype,
+                      "verification": state or "skipped"}
+    list(s3_workers.map(try_delete, bad_keys))
+
+    if rows:
+        with pool.cursor() as cur:
+            psycopg2.extras.execute_values(cur, FILE_UPSERT_MANY, rows,
+                template="(%s::uuid,%s,%s,%s,%s, now(), true, %s,%s)", page_size=BATCH_MAX)
+            verifier.enqueue_many(cur, jobs)
+            exif.enqueue_many(cur, [(r[0], r[4], r[2], r[3]) for r in rows])
+            thumbs.enqueue_many(cur, [(r[0], r[4], r[2], r[3]) for r in rows])
+            cur.execute("delete from pending_upload where file_id = any(%s::uuid[])", ([r[0] for r in rows],))
+            notify_schedule(cur); notify_changed(cur)
+        list_cache.bump()
+        audit.log_many(events)
+    return {"results": results}
+
+# --- Multipart-Uploads (große Dateien) ---
+# initiate -> parts (presigned UploadPart-URLs, beliebig viele pro Call) -> complete | abort.
+# Der Client lädt Parts parallel und wiederholt fehlgeschlagene einzeln. Key, Größe und
+# UploadId stehen in pending_upload; verwaiste Uploads bricht der Janitor ab.
+from botocore.exceptions import ClientError
+
+MULTIPART_MAX_BYTES = int(os.getenv("MULTIPART_MAX_BYTES", str(1024*1024*1024)))
+MULTIPART_PART_SIZE = int(os.getenv("MULTIPART_PART_SIZE", str(16*1024*1024)))
+MULTIPART_TTL_S = int(os.getenv("MULTIPART_TTL_S","86400"))
+PART_MIN_BYTES = 5*1024*1024      # S3-Minimum (außer letzter Part)
+PART_MAX_COUNT = 10000
+
+class MultipartInitIn(Presign2In):
+    part_size: Optional[int] = None
+
+class MultipartPartsIn(BaseModel):
+    upload_id: str
+    part_numbers: List[int] = Field(min_length=1, max_length=PART_MAX_COUNT)
+
+class MultipartPart(BaseModel):
+    part_number: int = Field(ge=1, le=PART_MAX_COUNT)
+    etag: str
+
+class MultipartCompleteIn(BaseModel):
+    upload_id: str
+    parts: List[MultipartPart] = Field(min_length=1, max_length=PART_MAX_COUNT)
+    sha256_hex: Optional[str] = None
+
+class MultipartAbortIn(BaseModel):
+    upload_id: str
+
+def part_layout(size: int, requested: Optional[int] = None):
+    """-> (part_size, part_count) innerhalb der S3-Grenzen."""
+    part_size = max(PART_MIN_BYTES, requested or MULTIPART_PART_SIZE, -(-size // PART_MAX_COUNT))
+    return part_size, -(-size // part_size)
+
+def multipart_pending(file_id: str, upload_id: str):
+    """-> (normalisierte file_id, (s3_key, size_bytes, content_type))"""
+    file_id = known_file_id(file_id)
+    with pool.cursor() as cur:
+        cur.execute(PENDING_LOOKUP + " and upload_id=%s", (file_id, upload_id))
+        r = cur.fetchone()
+    if not r: raise HTTPException(status_code=404, detail="multipart upload not found")
+    return file_id, r
+
+@app.post("/files/multipart/initiate")
+def multipart_initiate(inp: MultipartInitIn):
+    validate_upload_meta(inp.filename, inp.content_type, inp.size_bytes, max_bytes=MULTIPART_MAX_BYTES)
+    file_id = str(uuid.uuid4())
+    key = f"t-default/{file_id}/{sanitize_filename(inp.filename)}"
+    part_size, part_count = part_layout(inp.size_bytes, inp.part_size)
+    upload_id = s3_int.create_multipart_upload(Bucket=S3_BUCKET, Key=key, ContentType=inp.content_type)["UploadId"]
+    with pool.cursor() as cur:
+        cur.execute(PENDING_PRUNE)
+        cur.execute("insert into pending_upload(file_id, s3_key, size_bytes, content_type, expires_at, upload_id) "
+                    "values (%s,%s,%s,%s, now() + (%s)::interval, %s)",
+            (file_id, key, inp.size_bytes, inp.content_type, f"{MULTIPART_TTL_S} seconds", upload_id))
+    return {"file_id": file_id, "s3_key": key, "upload_id": upload_id,
+            "part_size": part_size, "part_count": part_count}
+
+@app.post("/files/multipart/{file_id}/parts")
+def multipart_parts(file_id: str, inp: MultipartPartsIn):
+    _, (key, _, _) = multipart_pending(file_id, inp.upload_id)
+    if any(n < 1 or n > PART_MAX_COUNT for n in inp.part_numbers):
+        raise HTTPException(status_code=400, detail="invalid part number")
+    urls = presigner.upload_part_urls(key, inp.upload_id, inp.part_numbers, expires=PRESIGN_EXPIRES)
+    return {"parts": [{"part_number": n, "url": u} for n, u in zip(inp.part_numbers, urls)]}
+
+@app.post("/files/multipart/{file_id}/complete")
+def multipart_complete(file_id: str, inp: MultipartCompleteIn):
+    file_id, pending = multipart_pending(file_id, inp.upload_id)
+    parts = sorted(inp.parts, key=lambda p: p.part_number)
+    if len({p.part_number for p in parts}) != len(parts):
+        raise HTTPException(status_code=400, detail="duplicate part number")
+    try:
+        s3_int.complete_multipart_upload(Bucket=S3_BUCKET, Key=pending[0], UploadId=inp.upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": p.part_number, "ETag": p.etag} for p in parts]})
+    except ClientError as e:
+        raise HTTPException(status_code=400, detail=f"complete failed: {e.response.get('Error', {}).get('Code')}")
+    return confirm_upload(file_id, inp.sha256_hex, max_bytes=MULTIPART_MAX_BYTES, pending=pending)
+
+@app.post("/files/multipart/{file_id}/abort")
+def multipart_abort(file_id: str, inp: MultipartAbortIn):
+    file_id, (key, _, _) = multipart_pending(file_id, inp.upload_id)
+    try: s3_int.abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=inp.upload_id)
+    except ClientError: pass   # schon abgebrochen/abgeschlossen
+    with pool.cursor() as cur:
+        cur.execute(PENDING_DONE, (file_id,))
+    return {"ok": True}
+
+# --- Katalog-Export (NDJSON) ---
+# Für Abgleiche gegen den Bucket: eine Zeile JSON pro file_object, gestreamt aus einem
+# Server-Side-Cursor in Blöcken von EXPORT_CHUNK_ROWS -> Speicher konstant, egal wie groß
+# der Katalog ist. Die Connection bleibt für die Dauer des Streams ausgecheckt.
+import json, zlib
+from fastapi.responses import StreamingResponse
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS","5000"))
+EXPORT_COLS = ("id", "filename", "size_bytes", "content_type", "s3_key", "sha256_hex",
+               "server_received_at", "within_24h", "verify_state")
+
+def export_rows(within_24h: Optional[bool], since: Optional[datetime], until: Optional[datetime]):
+    """Blöcke von Rows (Tupel in EXPORT_COLS-Reihenfolge), neueste zuerst."""
+    where, params = [VISIBLE], []
+    if within_24h is not None: where.append("within_24h = %s"); params.append(within_24h)
+    if since is not None: where.append("server_received_at >= %s"); params.append(since)
+    if until is not None: where.append("server_received_at < %s"); params.append(until)
+    cols = ", ".join("id::text" if c == "id" else c for c in EXPORT_COLS)
+    sql = (f"select {cols} from file_object where {' and '.join(where)} "
+           "order by server_received_at desc nulls last, id desc")
+    with pool.connection() as conn, conn.cursor(name="files_export") as cur:
+        cur.itersize = EXPORT_CHUNK_ROWS
+        cur.execute(sql, params)
         while True:
-            chunk = body.read(1024*1024)
-            if not chunk: break
-            h.update(chunk)
-        if h.hexdigest() != inp.sha256_hex.lower():
-            try: s3_int.delete_object(Bucket=S3_BUCKET, Key=key)
-            except Exception: pass
-            raise HTTPException(status_code=400, detail="sha256 mismatch")
+            rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows: break
+            yield rows
+
+def export_ndjson(chunks, urls: bool, url_expires: int):
+    for rows in chunks:
+        signed = make_get_urls([r[4] for r in rows], url_expires) if urls else None
+        lines = []
+        for i, r in enumerate(rows):
+            d = dict(zip(EXPORT_COLS, r))
+            if d["server_received_at"] is not None: d["server_received_at"] = d["server_received_at"].isoformat()
+            if urls: d["get_url"] = signed[i]
+            lines.append(json.dumps(d, ensure_ascii=False, separators=(",", ":")))
+        yield ("\n".join(lines) + "\n").encode()
+
+def gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)   # wbits 31 = gzip-Container
+    for c in chunks:
+        out = z.compress(c)
+        if out: yield out
+    yield z.flush()
+
+@app.get("/files/export")
+def files_export(within_24h: Optional[bool] = None, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                 urls: bool = False, url_expires: int = 3600, gzip: bool = False):
+    url_expires = max(60, min(url_expires, 7*24*3600))
+    body = export_ndjson(export_rows(within_24h, since, until), urls, url_expires)
+    if gzip:
+        # .gz-Datei als Inhalt (kein Content-Encoding): Clients entpacken nicht transparent
+        return StreamingResponse(gzip_stream(body), media_type="application/gzip",
+            headers={"Content-Disposition": 'attachment; filename="files.ndjson.gz"'})
+    return StreamingResponse(body, media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="files.ndjson"'})
+
+# --- Zertifikate: Gate-Regeln aus config/certificate.yaml (app/certificates.py) ---
+# Regeln werden einmal kompiliert (Cache nach Config-Hash) und spaltenweise über die ganze
+# Kohorte ausgewertet. Eingabe spaltenweise: {"columns": {"opt_in_pct": [..], "score": [..]}}.
+from typing import Any, Union
+from app import certificates
 
+CERT_CONFIG = os.getenv("CERT_CONFIG",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "config", "certificate.yaml"))
+CERT_MAX_ROWS = int(os.getenv("CERT_MAX_ROWS","100000"))
+
+class CertEvaluateIn(BaseModel):
+    columns: Dict[str, List[Optional[Union[bool, float]]]]
+    ids: Optional[List[str]] = None
+    # optional: eigene Regeln (z.B. What-if), sonst CERT_CONFIG
+    config: Optional[Dict[str, Any]] = None
+    details: bool = True       # failing: nicht erfüllte Klauseln pro Teilnehmer
+
+@app.post("/certificates/evaluate")
+def certificates_evaluate(inp: CertEvaluateIn):
+    n = max((len(c) for c in inp.columns.values()), default=0)
+    if n > CERT_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"max {CERT_MAX_ROWS} participants per request")
+    if inp.ids is not None and len(inp.ids) != n:
+        raise HTTPException(status_code=400, detail="ids must match column length")
+    try:
+        rules = certificates.compiled(inp.config) if inp.config is not None else certificates.from_file(CERT_CONFIG)
+        out = rules.evaluate(inp.columns, details=inp.details)
+    except certificates.RuleError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="certificate config not found")
+    if inp.ids is not None: out["ids"] = inp.ids
+    return out
+
+# --- Async-Modus (API2_ASYNC=true) ---
+# asyncpg + aiobotocore: presign2/confirm2/recent2/delete/retention halten während
+# S3-/DB-Wartezeiten keinen Threadpool-Worker mehr. Die sync-Handler oben bleiben
+# Default und Fallback; im Async-Modus werden ihre Routen ersetzt.
+from fastapi.routing import APIRoute
+from app.pool import create_async_pool
+from app.storage import AsyncS3Storage
+
+ASYNC_IO = os.getenv("API2_ASYNC","false").lower() in ("1","true","yes")
+aio = {"pool": None, "s3": None}
+
+async def aio_start():
+    # min_size=0: keine Connections beim Start (kein Warten auf die DB), Aufbau bei Bedarf
+    aio["pool"] = await create_async_pool(DB_URL, min_size=0)
+    aio["s3"] = AsyncS3Storage(S3_BUCKET, S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY)
+    await aio["s3"].start()
+
+async def aio_stop():
+    if aio["s3"]: await aio["s3"].close()
+    if aio["pool"]: await aio["pool"].close()
+
+async def presign2_async(inp: Presign2In):
+    file_id, key = upload_key(inp)
+    sha = dedup_sha_of(inp)
+    shared = None
+    async with aio["pool"].acquire() as conn, conn.transaction():
+        if sha:
+            shared = await blobs.acquire_async(conn, sha, inp.size_bytes, inp.content_type)
+        if shared:
+            await conn.execute(numbered(DEDUP_INSERT), file_id, sanitize_filename(inp.filename),
+                inp.size_bytes, inp.content_type, shared, sha)
+            await thumbs.enqueue_many_async(conn, [(file_id, shared, inp.size_bytes, inp.content_type)])
+            await notify_async(conn, SCHEDULE_CHANNEL, CHANGED_CHANNEL)
+        else:
+            await conn.execute(PENDING_PRUNE)
+            await conn.execute(numbered(PENDING_INSERT), file_id, key, inp.size_bytes, inp.content_type, PENDING_TTL_S)
+    if shared:
+        list_cache.bump()
+        audit.log("files.dedup","file_object",file_id,{"s3_key":shared,"sha256":sha})
+        return {"file_id": file_id, "s3_key": shared, "url": None, "deduplicated": True}
+    url = presigner.put_url(key, inp.content_type, expires=PRESIGN_EXPIRES)
+    return {"file_id": file_id, "s3_key": key, "url": url}
+
+async def notify_async(conn, *channels):
+    for ch in channels: await conn.execute(numbered(NOTIFY_SQL), ch)
+
+async def confirm2_async(inp: Confirm2In):
+    s3 = aio["s3"]; fid = known_file_id(inp.file_id)
+    pending = await aio["pool"].fetchrow(numbered(PENDING_LOOKUP), fid)
+    key = pending[0] if pending else await s3.first_key(f"t-default/{fid}/")
+    head = await s3.head(key) if key else None
+    if not head:
+        raise HTTPException(status_code=404, detail="object not found in S3")
+    size = head["size"]; ctype = head["content_type"] or "application/octet-stream"
+
+    err = check_uploaded(head, pending)
+    if err:
+        try: await s3.delete(key)
+        except Exception: pass
+        raise HTTPException(status_code=400, detail=err)
+
+    verify = verify_sha_of(inp.sha256_hex)
+    state = "pending" if verify else None
     filename = key.split("/", 2)[-1]
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      insert into file_object(id, filename, size_bytes, content_type, s3_key, server_received_at, within_24h)
-      values (%s,%s,%s,%s,%s, now(), true)
-      on conflict (id) do update
-        set filename=excluded.filename,
-            size_bytes=excluded.size_bytes,
-            content_type=excluded.content_type,
-            s3_key=excluded.s3_key,
-            server_received_at=excluded.server_received_at
-    """, (fid, filename, size, ctype, key))
-    conn.commit(); cur.close(); conn.close()
-    return {"ok": True, "size_bytes": size, "content_type": ctype}
-# --- /Upload-Validierung ---
+    async with aio["pool"].acquire() as conn, conn.transaction():
+        await conn.execute(numbered(FILE_UPSERT), fid, filename, size, ctype, key, verify, state)
+        if verify: await verifier.enqueue_many_async(conn, [(fid, key, size, verify)])
+        await exif.enqueue_many_async(conn, [(fid, key, size, ctype)])
+        await thumbs.enqueue_many_async(conn, [(fid, key, size, ctype)])
+        await conn.execute(numbered(PENDING_DONE), fid)
+        await notify_async(conn, SCHEDULE_CHANNEL, CHANGED_CHANNEL)
+    list_cache.bump()
+    audit.log("files.confirm","file_object",fid,{"size":size})
+    return {"ok": True, "size_bytes": size, "content_type": ctype, "verification": state or "skipped"}
+
+async def files_recent2_async(request: Request, response: Response, limit: int = 20, cursor: Optional[str] = None):
+    # Redis-Backend: kurze sync Calls (socket_timeout 0.5s) im Event-Loop
+    ck, hit = list_cache.lookup(request, "recent2", limit, cursor)
+    if hit: return hit
+    sql, params, limit = keyset_query(
+        "id::text, filename, size_bytes, content_type, s3_key, server_received_at, within_24h, thumb_key", limit, cursor)
+    rows = keyset_page(await aio["pool"].fetch(numbered(sql), *params), limit, response)
+    etag = list_cache.etag(rows)
+    nm = list_cache.unchanged(request, etag, response)
+    if nm: return nm
+    urls = make_get_urls([r[4] for r in rows] + [r[7] for r in rows])
+    return list_cache.store(request, ck, [{
+        "id":r[0],"filename":r[1],"size_bytes":r[2],"content_type":r[3],
+        "s3_key":r[4],"server_received_at":r[5],"get_url":url,"within_24h":r[6],"thumb_url":turl
+    } for r,url,turl in zip(rows,urls,urls[len(rows):])], response, etag)
+
+async def files_delete_async(file_id: str) -> Dict[str, bool]:
+    file_id = known_file_id(file_id)
+    async with aio["pool"].acquire() as conn:
+        key = await conn.fetchval(numbered(FILE_KEY_SQL), file_id)
+        if key is None:
+            return {"ok": False}
+        async with conn.transaction():
+            # geteilter Blob (Dedup) -> S3-Objekt bleibt, nur Refcount sinkt
+            gone = key not in await blobs.shared_keys_async(conn, [key])
+            await conn.execute(numbered(FILE_DELETE_SQL), file_id)
+            await blobs.drop_refs_async(conn, [key])
+            await notify_async(conn, CHANGED_CHANNEL)
+    if gone:
+        # S3 erst nach dem Commit: best effort, Original + Rendition in einem Call
+        try: await aio["s3"].delete_many([key, thumbs.thumb_key(key)])
+        except Exception: pass
+    list_cache.bump()
+    audit.log("files.delete","file_object",file_id,{"s3_key":key})
+    return {"ok": True}
+
+async def files_set_retention_async(file_id: str, inp: RetentionIn):
+    async with aio["pool"].acquire() as conn, conn.transaction():
+        r = await conn.fetchrow(numbered(RETENTION_SQL), inp.within_24h, file_id)
+        if r and inp.within_24h: await notify_async(conn, SCHEDULE_CHANNEL)
+        if r: await notify_async(conn, CHANGED_CHANNEL)
+    if not r: return {"ok": False}
+    list_cache.bump()
+    rid,fn,sz,ct,key,dt,w24,vs = r
+    return {
+      "ok": True,
+      "id": rid, "filename": fn, "size_bytes": sz, "content_type": ct,
+      "s3_key": key, "server_received_at": dt, "get_url": None if vs == "mismatch" else make_get_url(key),
+      "within_24h": w24
+    }
+
+ASYNC_ROUTES = [
+    ("/files/presign2", "POST", presign2_async, {"response_model": Presign2Out}),
+    ("/files/confirm2", "POST", confirm2_async, {}),
+    ("/files/recent2", "GET", files_recent2_async, {}),
+    ("/files/{file_id}", "DELETE", files_delete_async, {}),
+    ("/files/{file_id}/retention", "PATCH", files_set_retention_async, {}),
+]
+
+def use_async_routes():
+    """Ersetzt die sync-Routen aus ASYNC_ROUTES durch die async-Handler."""
+    swap = {(p, m) for p, m, _, _ in ASYNC_ROUTES}
+    app.router.routes[:] = [r for r in app.router.routes
+        if not (isinstance(r, APIRoute) and any((r.path, m) in swap for m in r.methods))]
+    for path, method, fn, kw in ASYNC_ROUTES:
+        app.add_api_route(path, fn, methods=[method], **kw)
+
+if ASYNC_IO:
+    use_async_routes()
@@ -0,0 +1,166 @@
+"""Prometheus-Metriken für api2 und die Worker (Janitor, Verifier).
+
+Hot Path bleibt billig: pro Request/Query/S3-Call zwei perf_counter() und ein
+observe() auf ein vorab gebundenes Histogramm-Child. Zustände, die es ohnehin
+als stats() gibt (DB-Pool, Listing-Cache, Audit-Puffer, Presign-Cache), werden
+erst beim Scrape gelesen (StatsCollector) -> kein Aufwand pro Request.
+
+  - HTTP: ASGI-Middleware, Label = Routen-Template (/files/{file_id}), nicht der Pfad
+  - S3:   botocore-Events before-call/after-call am Client (boto3 und aiobotocore),
+          Dauer bis zur Antwort (bei GET ohne Body-Streaming)
+  - DB:   Cursor-Factory des Pools (execute/executemany), Connect, Checkout-Wartezeit
+Ausgabe: GET /metrics (api2), Worker per --metrics-port (HTTP) oder --metrics-textfile
+(node_exporter textfile collector, z.B. für den Janitor mit --once per Cron).
+Mehrere uvicorn-Worker: PROMETHEUS_MULTIPROC_DIR setzen, /metrics aggregiert dann
+über alle Prozesse (Scrape-Zeit-Stats sind dort pro Prozess nicht enthalten).
+METRICS_ENABLED=false schaltet Middleware und Hooks ab.
+"""
+import os, time
+import psycopg2.extensions
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest, start_http_server, write_to_textfile)
+from prometheus_client.core import GaugeMetricFamily
+
+ENABLED = os.getenv("METRICS_ENABLED","true").lower() in ("1","true","yes")
+FAST = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+HTTP_SECONDS = Histogram("http_request_duration_seconds", "Dauer pro Route (bis zum letzten Byte)",
+    ["method", "route", "status"])
+S3_SECONDS = Histogram("s3_request_duration_seconds", "Dauer pro S3-Operation", ["op", "status"], buckets=FAST)
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Dauer pro Statement (Sync-Pool)", ["kind"], buckets=FAST)
+DB_CONNECT_SECONDS = Histogram("db_connect_duration_seconds", "Aufbau neuer DB-Connections", buckets=FAST)
+DB_CHECKOUT_SECONDS = Histogram("db_pool_checkout_duration_seconds", "Wartezeit auf eine Pool-Connection", buckets=FAST)
+
+# Verifier (SHA-256 aus confirm2)
+HASHED_BYTES = Counter("verify_hashed_bytes", "gehashte Bytes")
+HASH_SECONDS = Histogram("verify_hash_duration_seconds", "SHA-256 pro Objekt (inkl. Ranged GETs)",
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+VERIFIED = Counter("verify_results", "Ergebnisse", ["state"])
+
+# Janitor
+JANITOR_BATCH_ROWS = Histogram("janitor_batch_rows", "Rows pro Batch (geclaimt/gelesen)",
+    buckets=(1, 5, 10, 50, 100, 250, 500, 1000))
+JANITOR_DELETED = Counter("janitor_deleted_files", "gelöschte file_object-Rows")
+JANITOR_S3_FAILED = Counter("janitor_s3_delete_failed_keys", "Keys mit fehlgeschlagenem S3-Delete")
+JANITOR_SWEEP_SECONDS = Histogram("janitor_sweep_duration_seconds", "Dauer eines Cleanup-Laufs",
+    buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 900))
+JANITOR_BACKLOG_AGE = Gauge("janitor_backlog_age_seconds", "wie lange die älteste fällige Row schon fällig ist (0 = nichts fällig)")
+JANITOR_LAST_SWEEP = Gauge("janitor_last_sweep_timestamp_seconds", "Ende des letzten erfolgreichen Laufs (Unix-Zeit)")
+
+
+class StatsCollector:
+    """Numerische Werte aus fn() (dict) beim Scrape als Gauges <prefix>_<key>."""
+
+    def __init__(self, prefix, fn):
+        self.prefix, self.fn = prefix, fn
+
+    def collect(self):
+        try: st = self.fn()
+        except Exception: return
+        for k, v in st.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                yield GaugeMetricFamily(f"{self.prefix}_{k}", f"{self.prefix}.stats()['{k}']", value=v)
+
+
+def register_stats(prefix, fn):
+    if ENABLED: REGISTRY.register(StatsCollector(prefix, fn))
+
+
+def render():
+    """-> (body, content_type) für GET /metrics."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        reg = CollectorRegistry()
+        multiprocess.MultiProcessCollector(reg)
+        return generate_latest(reg), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def serve(port: int = 0):
+    """Worker: HTTP-Exporter auf port starten (0 = aus)."""
+    if ENABLED and port: start_http_server(port)
+
+def write_textfile(path):
+    if ENABLED and path: write_to_textfile(path, REGISTRY)   # atomar (tmp + rename)
+
+
+# --- HTTP ---
+
+class MetricsMiddleware:
+    """Reine ASGI-Middleware (kein BaseHTTPMiddleware: bricht Streaming nicht, kein Task pro Request)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        status = [500]
+        async def send_status(msg):
+            if msg["type"] == "http.response.start": status[0] = msg["status"]
+            await send(msg)
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # FastAPI legt die gematchte Route in den Scope -> begrenzte Kardinalität
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_SECONDS.labels(scope["method"], route, str(status[0])).observe(time.perf_counter() - t0)
+
+
+# --- S3 (botocore-Events) ---
+
+def _s3_before(model, context, **_):
+    context["metrics_t0"] = (model.name, time.perf_counter())
+
+def _s3_observe(context, status):
+    t = context.pop("metrics_t0", None)
+    if t is not None: S3_SECONDS.labels(t[0], status).observe(time.perf_counter() - t[1])
+
+def _s3_after(http_response, context, **_):
+    _s3_observe(context, str(http_response.status_code))    # 404 bei HEAD ist normal
+
+def _s3_error(context, **_):
+    _s3_observe(context, "error")                            # Verbindungsfehler, Timeout
+
+def instrument_boto(client):
+    """Zeitmessung für alle Operationen eines S3-Clients (boto3 oder aiobotocore)."""
+    if not ENABLED: return client
+    ev = client.meta.events
+    ev.register("before-call.s3", _s3_before)
+    ev.register("after-call.s3", _s3_after)
+    ev.register("after-call-error.s3", _s3_error)
+    return client
+
+
+# --- DB (psycopg2) ---
+
+_KINDS = {"select", "insert", "update", "delete", "with", "copy"}
+_query_children = {}
+
+def _query_hist(sql):
+    if isinstance(sql, bytes): sql = sql.decode("ascii", "ignore")
+    elif not isinstance(sql, str): sql = ""          # psycopg2.sql.Composed
+    word = sql[:32].split(None, 1)
+    kind = word[0].lower() if word and word[0].lower() in _KINDS else "other"
+    h = _query_children.get(kind)
+    if h is None: h = _query_children[kind] = DB_QUERY_SECONDS.labels(kind)
+    return h
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor-Factory für den Pool; misst execute/executemany (auch execute_values)."""
+
+    def execute(self, query, vars=None):
+        t0 = time.perf_counter()
+        try: return super().execute(query, vars)
+        finally: _query_hist(query).observe(time.perf_counter() - t0)
+
+    def executemany(self, query, vars_list):
+        t0 = time.perf_counter()
+        try: return super().executemany(query, vars_list)
+        finally: _query_hist(query).observe(time.perf_counter() - t0)
+
+
+def cursor_factory():
+    return TimedCursor if ENABLED else None
@@ -0,0 +1,161 @@
+"""Versionierte Schema-Migrationen für api2 (und die Worker, die dieselben Tabellen nutzen).
+
+Migrationen laufen einmal pro Deploy als eigener Schritt, nicht beim Import von
+app.main: python -m app.migrate (wartet auf die DB, wendet ausstehende Versionen an).
+api2 prüft beim Readiness-Check nur noch schema_migrations gegen SCHEMA_VERSION.
+
+  - jede Migration läuft in einer eigenen Transaktion und wird in schema_migrations vermerkt,
+  - ein Advisory-Lock serialisiert parallele Aufrufe (mehrere Replicas, Init-Container),
+  - Version 1 ist die bisherige ensure_schema-DDL (idempotent -> auch für Bestands-DBs).
+Neue Änderungen kommen als weitere (version, name, fn) ans Ende von MIGRATIONS und
+bleiben abwärtskompatibel (erst erweitern, dann umstellen), weil bei Rolling Deploys
+alte Instanzen gegen das neue Schema laufen.
+"""
+import os, sys, time, argparse
+import psycopg2
+from app import audit, blobs, exif, thumbs
+
+DB_URL = os.getenv("DATABASE_URL")
+LOCK_KEY = 0x617069326d6967   # "api2mig"
+
+
+def m001_baseline(cur):
+    # Savepoint: fehlgeschlagene Extension soll die restliche DDL nicht abbrechen
+    cur.execute("savepoint ext")
+    try: cur.execute("create extension if not exists pgcrypto;")
+    except Exception: cur.execute("rollback to savepoint ext")
+    cur.execute("""
+    create table if not exists file_object(
+      id uuid primary key default gen_random_uuid(),
+      filename text not null,
+      size_bytes bigint,
+      content_type text,
+      s3_key text not null,
+      sha256_hex text,
+      server_received_at timestamptz not null default now(),
+      exif_taken_at timestamptz,
+      within_24h boolean not null default true
+    );""")
+    # audit_log: monatlich partitioniert, Index auf entity_id (app/audit.py)
+    audit.ensure_schema(cur)
+    # Keyset-Pagination der Listings: (server_received_at desc nulls last, id desc)
+    cur.execute("""
+    create index if not exists file_object_recent_idx
+      on file_object (server_received_at desc nulls last, id desc);""")
+    # Janitor: nächste Fälligkeit = min(server_received_at) der ephemeren Files
+    cur.execute("""
+    create index if not exists file_object_expiry_idx
+      on file_object (server_received_at) where within_24h;""")
+    # SHA-256-Verifikation im Hintergrund (app/verifier.py): Status + Job-Queue
+    cur.execute("alter table file_object add column if not exists verify_state text;")
+    cur.execute("""
+    create table if not exists verify_job(
+      file_id uuid primary key references file_object(id) on delete cascade,
+      s3_key text not null,
+      size_bytes bigint not null,
+      expected_sha256 text not null,
+      enqueued_at timestamptz not null default now(),
+      attempts int not null default 0,
+      leased_until timestamptz
+    );""")
+    # EXIF-Extraktion im Hintergrund (app/exif.py)
+    exif.ensure_schema(cur)
+    # Thumbnails (app/thumbs.py): file_object.thumb_key + thumb_job
+    thumbs.ensure_schema(cur)
+    # Pending-Uploads aus presign2 (unlogged: nach Crash leer -> confirm2 fällt auf LIST zurück)
+    cur.execute("""
+    create unlogged table if not exists pending_upload(
+      file_id uuid primary key,
+      s3_key text not null,
+      size_bytes bigint not null,
+      content_type text not null,
+      expires_at timestamptz not null
+    );""")
+    cur.execute("create index if not exists pending_upload_expires_idx on pending_upload (expires_at);")
+    cur.execute("alter table pending_upload add column if not exists upload_id text;")
+    # Dedup: verifizierte Objekte als Blobs mit Refcount (app/blobs.py)
+    blobs.ensure_schema(cur)
+
+
+MIGRATIONS = [
+    (1, "baseline", m001_baseline),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cur) -> int:
+    """Höchste angewendete Version (0: noch nie migriert)."""
+    cur.execute("select to_regclass('schema_migrations') is not null")
+    if not cur.fetchone()[0]: return 0
+    cur.execute("select coalesce(max(version), 0) from schema_migrations")
+    return cur.fetchone()[0]
+
+
+def migrate(conn, target=SCHEMA_VERSION) -> list:
+    """Wendet ausstehende Migrationen bis target an -> [(version, name)]."""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("select pg_advisory_lock(%s)", (LOCK_KEY,))
+    try:
+        conn.autocommit = False
+        with conn.cursor() as cur:
+            cur.execute("""
+              create table if not exists schema_migrations(
+                version int primary key,
+                name text not null,
+                applied_at timestamptz not null default now()
+              );""")
+            conn.commit()
+            done = current_version(cur)
+            conn.commit()
+            applied = []
+            for version, name, fn in MIGRATIONS:
+                if version <= done or version > target: continue
+                t0 = time.perf_counter()
+                fn(cur)
+                cur.execute("insert into schema_migrations(version, name) values (%s, %s)", (version, name))
+                conn.commit()
+                print(f"[migrate] {version:03d} {name} ({time.perf_counter() - t0:.2f}s)")
+                applied.append((version, name))
+            return applied
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("select pg_advisory_unlock(%s)", (LOCK_KEY,))
+
+
+def connect(dsn, wait_s):
+    """Verbindet sich; wartet bis wait_s auf die DB (Compose/K8s-Start)."""
+    deadline = time.monotonic() + wait_s
+    while True:
+        try:
+            return psycopg2.connect(dsn)
+        except psycopg2.OperationalError as e:
+            if time.monotonic() >= deadline: raise
+            print(f"[migrate] waiting for db: {str(e).strip()}")
+            time.sleep(1)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--check", action="store_true", help="nur prüfen; Exit 1, wenn Migrationen ausstehen")
+    ap.add_argument("--wait-seconds", type=float, default=float(os.getenv("MIGRATE_WAIT_SECONDS","60")))
+    args = ap.parse_args()
+    conn = connect(DB_URL, args.wait_seconds)
+    try:
+        if args.check:
+            with conn.cursor() as cur:
+                v = current_version(cur)
+            print(f"[migrate] schema version {v}, expected {SCHEMA_VERSION}")
+            sys.exit(0 if v >= SCHEMA_VERSION else 1)
+        applied = migrate(conn)
+        print(f"[migrate] schema at version {SCHEMA_VERSION}" + ("" if applied else " (nothing to do)"))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
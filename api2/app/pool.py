@@ -0,0 +1,226 @@
+"""Postgres-Connection-Pool für api2 und Janitor.
+
+Einfacher, thread-sicherer Pool über psycopg2 mit
+  - min/max Größe (DB_POOL_MIN / DB_POOL_MAX),
+  - Health-Check beim Auschecken (idle > DB_POOL_CHECK_IDLE_S -> "select 1"),
+  - statement_timeout pro Connection (DB_STATEMENT_TIMEOUT_MS),
+    optional idle_in_transaction_session_timeout (bricht hängende Transaktionen ab),
+  - Context-Manager-API (commit bei Erfolg, rollback bei Exception),
+  - Stats (in_use, idle, waiting, Checkout-Latenz) zum Dimensionieren unter Last,
+  - Metriken (app/metrics.py): Query-Dauer per Cursor-Factory, Connect, Checkout.
+SQL wird einmal mit %s-Platzhaltern geschrieben; der Async-Modus (asyncpg) nutzt
+denselben Text über numbered().
+"""
+import os, re, time, threading, itertools
+from functools import lru_cache
+from contextlib import contextmanager
+import psycopg2, psycopg2.extensions
+from app import metrics
+
+
+class PoolTimeout(Exception):
+    """Keine Connection innerhalb von checkout_timeout_s frei geworden."""
+
+
+class Pool:
+    def __init__(self, dsn, minconn=1, maxconn=10, statement_timeout_ms=30000,
+                 checkout_timeout_s=10.0, check_idle_s=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.statement_timeout_ms = statement_timeout_ms
+        self.checkout_timeout_s = checkout_timeout_s
+        self.check_idle_s = check_idle_s
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, last_used_monotonic)]
+        self._size = 0           # offene Connections (idle + in_use)
+        self._waiting = 0
+        self._closed = False
+        self._st = {"checkouts": 0, "timeouts": 0, "discarded": 0, "created": 0,
+                    "checkout_ms_total": 0.0, "checkout_ms_max": 0.0}
+
+    def _connect(self):
+        opts = []
+        if self.statement_timeout_ms:
+            opts.append(f"-c statement_timeout={int(self.statement_timeout_ms)}")
+        kw = {"options": " ".join(opts)} if opts else {}
+        if metrics.cursor_factory(): kw["cursor_factory"] = metrics.cursor_factory()
+        t0 = time.perf_counter()
+        conn = psycopg2.connect(self.dsn, **kw)
+        metrics.DB_CONNECT_SECONDS.observe(time.perf_counter() - t0)
+        with self._cond:
+            self._st["created"] += 1
+        return conn
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try: conn.rollback()
+            except Exception: return False
+        if time.monotonic() - last_used < self.check_idle_s:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try: conn.close()
+        except Exception: pass
+        with self._cond:
+            self._size -= 1
+            self._st["discarded"] += 1
+            self._cond.notify()
+
+    def getconn(self, timeout=None):
+        timeout = self.checkout_timeout_s if timeout is None else timeout
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        while True:
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("pool closed")
+                self._waiting += 1
+                try:
+                    while not self._idle and self._size >= self.maxconn:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            self._st["timeouts"] += 1
+                            raise PoolTimeout(f"no connection available within {timeout}s")
+                        self._cond.wait(left)
+                finally:
+                    self._waiting -= 1
+                if self._idle:
+                    conn, last = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn, last):
+                self._discard(conn)
+                continue
+            ms = (time.monotonic() - t0) * 1000.0
+            metrics.DB_CHECKOUT_SECONDS.observe(ms / 1000.0)
+            with self._cond:
+                self._st["checkouts"] += 1
+                self._st["checkout_ms_total"] += ms
+                self._st["checkout_ms_max"] = max(self._st["checkout_ms_max"], ms)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try: conn.rollback()
+            except Exception:
+                self._discard(conn); return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """with pool.connection() as conn: ... -> commit bei Erfolg, rollback bei Fehler."""
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try: conn.rollback()
+            except Exception: broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken or bool(conn.closed))
+
+    @contextmanager
+    def cursor(self, timeout=None, **kw):
+        with self.connection(timeout) as conn:
+            with conn.cursor(**kw) as cur:
+                yield cur
+
+    def stats(self):
+        with self._cond:
+            n = self._st["checkouts"]
+            return {
+                "size": self._size,
+                "min": self.minconn,
+                "max": self.maxconn,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": n,
+                "timeouts": self._st["timeouts"],
+                "created": self._st["created"],
+                "discarded": self._st["discarded"],
+                "checkout_ms_avg": round(self._st["checkout_ms_total"] / n, 3) if n else 0.0,
+                "checkout_ms_max": round(self._st["checkout_ms_max"], 3),
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            try: conn.close()
+            except Exception: pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(**overrides) -> Pool:
+    """Prozessweiter Pool; Größe/Timeouts aus ENV, überschreibbar beim ersten Aufruf."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                cfg = dict(
+                    dsn=os.getenv("DATABASE_URL"),
+                    minconn=int(os.getenv("DB_POOL_MIN", "1")),
+                    maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+                    statement_timeout_ms=int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000")),
+                    checkout_timeout_s=float(os.getenv("DB_POOL_TIMEOUT_S", "10")),
+                    check_idle_s=float(os.getenv("DB_POOL_CHECK_IDLE_S", "30")),
+                )
+                cfg.update(overrides)
+                _pool = Pool(**cfg)
+    return _pool
+
+
+@lru_cache(maxsize=None)
+def numbered(sql: str) -> str:
+    """psycopg2-Platzhalter (%s) -> asyncpg ($1, $2, …); %% wird zu %."""
+    n = itertools.count(1)
+    return re.sub(r"%%|%s", lambda m: "%" if m.group() == "%%" else f"${next(n)}", sql)
+
+
+async def create_async_pool(dsn=None, **overrides):
+    """asyncpg-Pool für den Async-Modus (API2_ASYNC); gleiche ENV-Knöpfe wie der Sync-Pool."""
+    import asyncpg
+    cfg = dict(
+        min_size=int(os.getenv("DB_POOL_MIN", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX", "10")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT_S", "10")),
+        max_inactive_connection_lifetime=float(os.getenv("DB_POOL_CHECK_IDLE_S", "30")) * 10,
+        server_settings={"statement_timeout": os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000")},
+    )
+    cfg.update(overrides)
+    return await asyncpg.create_pool(dsn or os.getenv("DATABASE_URL"), **cfg)
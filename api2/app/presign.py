@@ -0,0 +1,150 @@
+"""Lokaler SigV4-Presigner für S3 (path-style, Query-Auth).
+
+Ersetzt s3_pub.generate_presigned_url im Listing-Hotpath: der Signing-Key wird
+einmal pro Tag/Region/Service abgeleitet und wiederverwendet, viele Keys werden
+in einer Schleife signiert. Output ist byte-identisch zu botocore
+(S3SigV4QueryAuth, addressing_style=path) bei gleichem Zeitstempel.
+
+Optionaler LRU-Cache pro (Methode, Key, Content-Type, Ablauf-Bucket): innerhalb
+eines Buckets von bucket_s Sekunden wird mit dem Bucket-Startzeitpunkt signiert
+und X-Amz-Expires um bucket_s verlängert – jede ausgelieferte URL ist also
+mindestens `expires` Sekunden gültig, wiederholte Listings kosten nur einen Lookup.
+"""
+import hashlib, hmac, threading, time
+from collections import OrderedDict
+from urllib.parse import quote, urlsplit
+
+ALGO = "AWS4-HMAC-SHA256"
+MAX_EXPIRES = 7 * 24 * 3600
+
+
+def _enc(s, safe="-_.~"):
+    return quote(s, safe=safe)
+
+
+class Presigner:
+    def __init__(self, endpoint_url, access_key, secret_key, bucket,
+                 region="us-east-1", service="s3", cache_size=0, bucket_s=0):
+        u = urlsplit(endpoint_url.rstrip("/"))
+        host = u.netloc
+        # Default-Ports lässt botocore im Host-Header weg
+        if (u.scheme, u.port) in (("http", 80), ("https", 443)):
+            host = host.rsplit(":", 1)[0]
+        self.host = host
+        self.origin = f"{u.scheme}://{u.netloc}"
+        self.path_prefix = f"{u.path}/{_enc(bucket, '/~')}/"
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.service = service
+        self.cache_size = cache_size
+        self.bucket_s = bucket_s if cache_size > 0 else 0
+        self._keys = {}            # datestamp -> signing key
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def signing_key(self, datestamp):
+        k = self._keys.get(datestamp)
+        if k is None:
+            k = hmac.new(("AWS4" + self.secret_key).encode(), datestamp.encode(), hashlib.sha256).digest()
+            for part in (self.region, self.service, "aws4_request"):
+                k = hmac.new(k, part.encode(), hashlib.sha256).digest()
+            self._keys = {datestamp: k}   # ältere Tage verwerfen
+        return k
+
+    def _sign_many(self, method, keys, expires, ts, content_type=None, params=()):
+        """params: Operations-Query (z.B. partNumber/uploadId) – steht in der URL vor den
+        Auth-Parametern, in der kanonischen Query sortiert (wie botocore)."""
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(ts))
+        datestamp = amz_date[:8]
+        scope = f"{datestamp}/{self.region}/{self.service}/aws4_request"
+        skey = self.signing_key(datestamp)
+        if content_type is not None:
+            signed = "content-type;host"
+            canon_headers = f"content-type:{content_type.strip()}\nhost:{self.host}\n"
+        else:
+            signed = "host"
+            canon_headers = f"host:{self.host}\n"
+        query = (f"X-Amz-Algorithm={ALGO}"
+                 f"&X-Amz-Credential={_enc(self.access_key + '/' + scope)}"
+                 f"&X-Amz-Date={amz_date}&X-Amz-Expires={int(expires)}"
+                 f"&X-Amz-SignedHeaders={_enc(signed)}")
+        op = [(_enc(k), _enc(str(v))) for k, v in params]
+        canon_query = "&".join(f"{k}={v}" for k, v in sorted(op + [tuple(p.split("=", 1)) for p in query.split("&")]))
+        if op:
+            query = "&".join(f"{k}={v}" for k, v in op) + "&" + query
+        tail = f"\n{canon_query}\n{canon_headers}\n{signed}\nUNSIGNED-PAYLOAD"
+        head = f"{ALGO}\n{amz_date}\n{scope}\n"
+        out = []
+        for key in keys:
+            path = self.path_prefix + _enc(key, "/~")
+            creq = f"{method}\n{path}{tail}"
+            sts = head + hashlib.sha256(creq.encode()).hexdigest()
+            sig = hmac.new(skey, sts.encode(), hashlib.sha256).hexdigest()
+            out.append(f"{self.origin}{path}?{query}&X-Amz-Signature={sig}")
+        return out
+
+    def _window(self, expires, now):
+        if not self.bucket_s:
+            return int(now), expires
+        start = int(now) - int(now) % self.bucket_s
+        return start, min(expires + self.bucket_s, MAX_EXPIRES)
+
+    def sign(self, method, keys, expires=900, content_type=None, now=None):
+        """Signiert alle keys; mit Cache nur die fehlenden."""
+        now = time.time() if now is None else now
+        ts, exp = self._window(expires, now)
+        if not self.cache_size:
+            return self._sign_many(method, keys, exp, ts, content_type)
+        out = [None] * len(keys); todo = []
+        with self._lock:
+            for i, k in enumerate(keys):
+                ck = (method, k, content_type, expires, ts)
+                url = self._cache.get(ck)
+                if url is None: todo.append(i)
+                else:
+                    self._cache.move_to_end(ck); out[i] = url
+            self.hits += len(keys) - len(todo); self.misses += len(todo)
+        if todo:
+            fresh = self._sign_many(method, [keys[i] for i in todo], exp, ts, content_type)
+            with self._lock:
+                for i, url in zip(todo, fresh):
+                    out[i] = url
+                    self._cache[(method, keys[i], content_type, expires, ts)] = url
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return out
+
+    def get_urls(self, keys, expires=900, now=None):
+        return self.sign("GET", keys, expires, now=now)
+
+    def get_url(self, key, expires=900, now=None):
+        return self.sign("GET", [key], expires, now=now)[0]
+
+    def put_url(self, key, content_type, expires=900, now=None):
+        # PUT-URLs sind Einmal-URLs -> nie aus dem Cache
+        ts = int(time.time() if now is None else now)
+        return self._sign_many("PUT", [key], expires, ts, content_type)[0]
+
+    def put_urls(self, items, expires=900, now=None):
+        """[(key, content_type)] -> URLs in gleicher Reihenfolge; ein Zeitstempel und
+        Signing-Key für alle, gruppiert nach Content-Type."""
+        ts = int(time.time() if now is None else now)
+        out = [None] * len(items); groups = {}
+        for i, (_, ct) in enumerate(items):
+            groups.setdefault(ct, []).append(i)
+        for ct, idx in groups.items():
+            for i, url in zip(idx, self._sign_many("PUT", [items[i][0] for i in idx], expires, ts, ct)):
+                out[i] = url
+        return out
+
+    def upload_part_urls(self, key, upload_id, part_numbers, expires=900, now=None):
+        """Presigned UploadPart-URLs für einen Multipart-Upload (ein Zeitstempel für alle Parts)."""
+        ts = int(time.time() if now is None else now)
+        return [self._sign_many("PUT", [key], expires, ts, None,
+                                (("uploadId", upload_id), ("partNumber", n)))[0] for n in part_numbers]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "max": self.cache_size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,134 @@
+"""Kleine S3-Abstraktion (HEAD/GET/Range-GET/COPY/DELETE/LIST) – sync über boto3, async über aiobotocore.
+
+Die Handler sprechen nur mit diesen Methoden; damit kann der Async-Modus
+(API2_ASYNC=true) dieselbe Logik ohne Threadpool-Worker fahren.
+"""
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from app import metrics
+
+S3_CONFIG = Config(s3={"addressing_style": "path"}, signature_version="s3v4")
+REGION = "us-east-1"
+
+
+def _not_found(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+class S3Storage:
+    """Sync-Variante (boto3)."""
+
+    def __init__(self, bucket, endpoint_url, access_key, secret_key, client=None):
+        self.bucket = bucket
+        # fremde Clients (client=...) instrumentiert der Aufrufer
+        self.client = client or metrics.instrument_boto(boto3.client("s3", endpoint_url=endpoint_url,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+            config=S3_CONFIG, region_name=REGION))
+
+    def head(self, key):
+        """-> {"size", "content_type"} oder None, wenn das Objekt fehlt."""
+        try:
+            h = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if _not_found(e): return None
+            raise
+        return {"size": int(h.get("ContentLength", 0) or 0), "content_type": h.get("ContentType")}
+
+    def first_key(self, prefix):
+        res = self.client.list_objects_v2(Bucket=self.bucket, Prefix=prefix, MaxKeys=1)
+        items = res.get("Contents") or []
+        return items[0]["Key"] if items else None
+
+    def iter_chunks(self, key, chunk_size=1024*1024):
+        body = self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        try:
+            while True:
+                chunk = body.read(chunk_size)
+                if not chunk: break
+                yield chunk
+        finally:
+            body.close()
+
+    def read_range(self, key, start, end):
+        """Ranged GET [start, end) -> bytes (für kleine Header-Reads)."""
+        body = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end-1}")["Body"]
+        try: return body.read()
+        finally: body.close()
+
+    def read_range_into(self, key, start, end, buf):
+        """Ranged GET [start, end) direkt in einen wiederverwendbaren Puffer -> gelesene Bytes."""
+        body = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end-1}")["Body"]
+        # urllib3-Response kann readinto (kein Zwischen-bytes-Objekt); sonst read()
+        raw = getattr(body, "_raw_stream", None)
+        mv, n, want = memoryview(buf), 0, end - start
+        try:
+            while n < want:
+                if hasattr(raw, "readinto"):
+                    got = raw.readinto(mv[n:want])
+                else:
+                    chunk = body.read(want - n); got = len(chunk); mv[n:n+got] = chunk
+                if not got: break
+                n += got
+        finally:
+            body.close()
+        return n
+
+    def put(self, key, data, content_type):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type)
+
+    def copy(self, src, dst):
+        self.client.copy_object(Bucket=self.bucket, Key=dst, CopySource={"Bucket": self.bucket, "Key": src})
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class AsyncS3Storage:
+    """Async-Variante (aiobotocore); Client wird in start()/close() auf- und abgebaut."""
+
+    def __init__(self, bucket, endpoint_url, access_key, secret_key):
+        self.bucket = bucket
+        self._kw = dict(endpoint_url=endpoint_url, aws_access_key_id=access_key,
+                        aws_secret_access_key=secret_key, config=S3_CONFIG, region_name=REGION)
+        self._cm = None
+        self.client = None
+
+    async def start(self):
+        from aiobotocore.session import get_session
+        self._cm = get_session().create_client("s3", **self._kw)
+        self.client = metrics.instrument_boto(await self._cm.__aenter__())
+
+    async def close(self):
+        if self._cm is not None:
+            await self._cm.__aexit__(None, None, None)
+            self._cm = self.client = None
+
+    async def head(self, key):
+        try:
+            h = await self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if _not_found(e): return None
+            raise
+        return {"size": int(h.get("ContentLength", 0) or 0), "content_type": h.get("ContentType")}
+
+    async def first_key(self, prefix):
+        res = await self.client.list_objects_v2(Bucket=self.bucket, Prefix=prefix, MaxKeys=1)
+        items = res.get("Contents") or []
+        return items[0]["Key"] if items else None
+
+    async def iter_chunks(self, key, chunk_size=1024*1024):
+        res = await self.client.get_object(Bucket=self.bucket, Key=key)
+        async with res["Body"] as body:
+            while True:
+                chunk = await body.read(chunk_size)
+                if not chunk: break
+                yield chunk
+
+    async def delete(self, key):
+        await self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    async def delete_many(self, keys):
+        # ein DeleteObjects-Call statt je Key ein Roundtrip
+        await self.client.delete_objects(Bucket=self.bucket, Delete={"Quiet": True,
+            "Objects": [{"Key": k} for k in keys]})
@@ -0,0 +1,213 @@
+"""Thumbnail-Worker: kleine WebP-Vorschauen für Bilder und PDFs (erste Seite).
+
+confirm2 legt für Bilder/PDFs einen Job in thumb_job an; dieser Worker
+  - claimt Jobs blockweise per Lease (FOR UPDATE SKIP LOCKED) -> mehrere Replicas ok,
+  - rendert in einem Prozess-Pool (THUMB_WORKERS): Original laden, auf THUMB_PX
+    verkleinern (JPEG per draft() schon beim Dekodieren), als WebP speichern,
+  - legt die Rendition neben dem Original ab (thumb_key(s3_key)) und setzt
+    file_object.thumb_key; Listings liefern daraus thumb_url.
+PDF-Vorschauen brauchen pdftoppm (poppler-utils); fehlt es, bleibt thumb_key leer.
+Renditions werden zusammen mit dem Original gelöscht (files_delete, Janitor).
+Start: python -m app.thumbs
+"""
+import os, io, sys, time, shutil, select, signal, argparse, tempfile, subprocess
+from concurrent.futures import ProcessPoolExecutor
+import psycopg2, psycopg2.extras
+from app.pool import get_pool, numbered
+from app.storage import S3Storage
+
+DB_URL = os.getenv("DATABASE_URL")
+S3_BUCKET = os.getenv("S3_BUCKET","artifacts")
+THUMB_CHANNEL = "thumb_jobs"
+CHANGED_CHANNEL = "file_object_changed"
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp"}
+PDF_TYPE = "application/pdf"
+THUMB_SUFFIX = ".thumb.webp"
+WORKERS = int(os.getenv("THUMB_WORKERS","2"))
+BATCH = int(os.getenv("THUMB_BATCH","16"))
+THUMB_PX = int(os.getenv("THUMB_PX","320"))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY","75"))
+MAX_SOURCE_BYTES = int(float(os.getenv("THUMB_MAX_SOURCE_MB","50")) * 1024 * 1024)
+LEASE_S = int(os.getenv("THUMB_LEASE_S","300"))
+MAX_ATTEMPTS = int(os.getenv("THUMB_MAX_ATTEMPTS","3"))
+
+
+def thumb_key(s3_key: str) -> str:
+    """Rendition liegt neben dem Original: t-default/<id>/<name>.thumb.webp"""
+    return s3_key + THUMB_SUFFIX
+
+
+def ensure_schema(cur):
+    cur.execute("alter table file_object add column if not exists thumb_key text;")
+    cur.execute("""
+    create table if not exists thumb_job(
+      file_id uuid primary key references file_object(id) on delete cascade,
+      s3_key text not null,
+      size_bytes bigint not null,
+      content_type text not null,
+      enqueued_at timestamptz not null default now(),
+      attempts int not null default 0,
+      leased_until timestamptz
+    );""")
+
+
+def wants(content_type, size=0) -> bool:
+    return (content_type in IMAGE_TYPES or content_type == PDF_TYPE) and size <= MAX_SOURCE_BYTES
+
+
+# Multi-Row per unnest: ein Statement für psycopg2 und asyncpg (numbered)
+ENQUEUE_SQL = """
+  insert into thumb_job(file_id, s3_key, size_bytes, content_type)
+  select * from unnest(%s::uuid[], %s::text[], %s::bigint[], %s::text[])
+  on conflict (file_id) do update
+    set s3_key=excluded.s3_key, size_bytes=excluded.size_bytes, content_type=excluded.content_type,
+        attempts=0, leased_until=null, enqueued_at=now()
+"""
+NOTIFY_SQL = "select pg_notify(%s, '')"
+
+
+def _columns(jobs):
+    """[(file_id, s3_key, size, content_type)] -> Spalten-Arrays der relevanten Jobs (leer: None)."""
+    jobs = [j for j in jobs if wants(j[3], j[2])]
+    if not jobs: return None
+    return ([str(j[0]) for j in jobs], [j[1] for j in jobs], [j[2] for j in jobs], [j[3] for j in jobs])
+
+
+def enqueue_many(cur, jobs):
+    """jobs: [(file_id, s3_key, size, content_type)]; nicht renderbare werden übergangen."""
+    cols = _columns(jobs)
+    if not cols: return
+    cur.execute(ENQUEUE_SQL, cols)
+    cur.execute(NOTIFY_SQL, (THUMB_CHANNEL,))
+
+
+async def enqueue_many_async(conn, jobs):
+    """Async-Modus (asyncpg-Connection in laufender Transaktion)."""
+    cols = _columns(jobs)
+    if not cols: return
+    await conn.execute(numbered(ENQUEUE_SQL), *cols)
+    await conn.execute(numbered(NOTIFY_SQL), THUMB_CHANNEL)
+
+
+# --- Rendering (läuft im Prozess-Pool) ---
+
+def render_image(data: bytes) -> bytes:
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as im:
+        im.draft("RGB", (THUMB_PX, THUMB_PX))          # JPEG: skaliert beim Dekodieren
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((THUMB_PX, THUMB_PX))
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        out = io.BytesIO()
+        im.save(out, "WEBP", quality=THUMB_QUALITY, method=4)
+        return out.getvalue()
+
+
+def render_pdf(data: bytes):
+    """Erste Seite per pdftoppm -> WebP; None, wenn pdftoppm fehlt."""
+    exe = shutil.which("pdftoppm")
+    if not exe: return None
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, "in.pdf")
+        with open(src, "wb") as f: f.write(data)
+        subprocess.run([exe, "-f", "1", "-l", "1", "-singlefile", "-scale-to", str(THUMB_PX), "-png",
+                        src, os.path.join(d, "page")], check=True, timeout=60, capture_output=True)
+        with open(os.path.join(d, "page.png"), "rb") as f:
+            return render_image(f.read())
+
+
+_storage = None
+
+def _init_process():
+    global _storage
+    _storage = S3Storage(S3_BUCKET, os.getenv("S3_ENDPOINT"), os.getenv("S3_ACCESS_KEY"), os.getenv("S3_SECRET_KEY"))
+
+def render_job(job):
+    """Im Pool-Prozess: -> (file_id, thumb_key|None, Fehlertext|None)."""
+    fid, key, size, ctype, _ = job
+    tkey = thumb_key(key)
+    try:
+        # Dedup-Rows teilen Original und Rendition -> schon vorhanden, nichts zu tun
+        if _storage.head(tkey): return fid, tkey, None
+        data = b"".join(_storage.iter_chunks(key))
+        webp = render_pdf(data) if ctype == PDF_TYPE else render_image(data)
+        if webp is None: return fid, None, None
+        _storage.put(tkey, webp, "image/webp")
+        return fid, tkey, None
+    except Exception as ex:
+        return fid, None, f"{type(ex).__name__}: {ex}"[:200]
+
+
+def claim(pool, n):
+    with pool.cursor() as cur:
+        cur.execute("""
+          update thumb_job set leased_until = now() + (%s)::interval, attempts = attempts + 1
+          where file_id in (
+            select file_id from thumb_job
+            where leased_until is null or leased_until < now()
+            order by enqueued_at
+            limit %s
+            for update skip locked)
+          returning file_id::text, s3_key, size_bytes, content_type, attempts
+        """, (f"{LEASE_S} seconds", n))
+        return cur.fetchall()
+
+
+def store(pool, jobs, results):
+    """thumb_key eines Blocks setzen; fehlgeschlagene Jobs bleiben bis MAX_ATTEMPTS liegen."""
+    attempts = {j[0]: j[4] for j in jobs}
+    found = [(fid, tkey) for fid, tkey, err in results if tkey]
+    done = [fid for fid, _, err in results if not err or attempts[fid] >= MAX_ATTEMPTS]
+    for fid, _, err in results:
+        if err: print(f"[thumbs] {fid}: {err} (attempt {attempts[fid]})")
+    with pool.cursor() as cur:
+        if found:
+            # nur, solange die Row noch auf dasselbe Original zeigt (Quarantäne ändert s3_key)
+            psycopg2.extras.execute_values(cur, f"""
+              update file_object f set thumb_key = v.k
+              from (values %s) v(id, k) where f.id = v.id and f.s3_key || '{THUMB_SUFFIX}' = v.k
+            """, [(fid, k) for fid, k in found], template="(%s::uuid,%s)", page_size=1000)
+            cur.execute("select pg_notify(%s, '')", (CHANGED_CHANNEL,))   # Listing-Caches der API
+        if done:
+            cur.execute("delete from thumb_job where file_id = any(%s::uuid[])", (done,))
+    return len(found)
+
+
+def listen():
+    conn = psycopg2.connect(DB_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"listen {THUMB_CHANNEL}")
+    return conn
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--poll-seconds", type=float, default=float(os.getenv("THUMB_POLL_SECONDS","30")),
+        help="Fallback-Poll, falls ein NOTIFY verloren geht")
+    args = ap.parse_args()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    pool = get_pool(dsn=DB_URL, minconn=0, maxconn=2)
+    procs = ProcessPoolExecutor(max(1, WORKERS), initializer=_init_process)
+    print(f"[thumbs] workers={WORKERS} batch={BATCH} px={THUMB_PX} pdf={'yes' if shutil.which('pdftoppm') else 'no'}")
+    listener = None
+    while True:
+        try:
+            if listener is None or listener.closed:
+                listener = listen()
+            jobs = claim(pool, BATCH)
+            if jobs:
+                n = store(pool, jobs, list(procs.map(render_job, jobs)))
+                print(f"[thumbs] {len(jobs)} job(s), {n} rendition(s)")
+                if len(jobs) == BATCH: continue        # Rückstau -> sofort weiter
+            if select.select([listener], [], [], args.poll_seconds) != ([], [], []):
+                listener.poll(); listener.notifies.clear()
+        except Exception as e:
+            print(f"[thumbs] ERROR: {e}")
+            listener = None
+            time.sleep(5)
+
+
+if __name__ == "__main__":
+    main()
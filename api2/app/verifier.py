@@ -0,0 +1,220 @@
+"""SHA-256-Verifier: prüft hochgeladene Objekte im Hintergrund statt in confirm2.
+
+Queue = Tabelle verify_job (angelegt per python -m app.migrate). confirm2 legt einen
+Job an und antwortet sofort mit verification=pending; dieser Worker
+  - claimt Jobs per Lease (leased_until, FOR UPDATE SKIP LOCKED) -> mehrere Replicas ok,
+  - hasht mehrere Objekte parallel (VERIFY_WORKERS),
+  - liest jedes Objekt per parallelen Ranged-GETs (VERIFY_PREFETCH) in wiederverwendbare
+    Puffer (VERIFY_RANGE_MB) und hasht die Ranges in Reihenfolge,
+  - setzt file_object.verify_state auf ok | mismatch | error; Mismatches werden nach
+    quarantine/<key> verschoben und von Listings, Export und Download ausgeblendet.
+Start: python -m app.verifier
+"""
+import os, sys, time, queue, select, signal, hashlib, argparse, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from app.pool import get_pool, numbered
+from app import audit, blobs, thumbs, metrics
+from app.storage import S3Storage
+
+DB_URL = os.getenv("DATABASE_URL")
+S3_BUCKET = os.getenv("S3_BUCKET","artifacts")
+VERIFY_CHANNEL = "verify_jobs"
+WORKERS = int(os.getenv("VERIFY_WORKERS","4"))
+PREFETCH = int(os.getenv("VERIFY_PREFETCH","4"))
+RANGE_BYTES = int(float(os.getenv("VERIFY_RANGE_MB","8")) * 1024 * 1024)
+LEASE_S = int(os.getenv("VERIFY_LEASE_S","600"))
+MAX_ATTEMPTS = int(os.getenv("VERIFY_MAX_ATTEMPTS","3"))
+QUARANTINE_PREFIX = "quarantine/"
+
+
+# Multi-Row per unnest: ein Statement für psycopg2 und asyncpg (numbered)
+ENQUEUE_SQL = """
+  insert into verify_job(file_id, s3_key, size_bytes, expected_sha256)
+  select * from unnest(%s::uuid[], %s::text[], %s::bigint[], %s::text[])
+  on conflict (file_id) do update
+    set s3_key=excluded.s3_key, size_bytes=excluded.size_bytes,
+        expected_sha256=excluded.expected_sha256, attempts=0, leased_until=null,
+        enqueued_at=now()
+"""
+NOTIFY_SQL = "select pg_notify(%s, '')"
+
+
+def _columns(jobs):
+    return ([str(f) for f, _, _, _ in jobs], [k for _, k, _, _ in jobs],
+            [n for _, _, n, _ in jobs], [sha.lower() for _, _, _, sha in jobs])
+
+
+def enqueue(cur, file_id, s3_key, size, expected_sha256):
+    """Von confirm2 aufgerufen (gleiche Transaktion): Job anlegen + Worker wecken."""
+    enqueue_many(cur, [(file_id, s3_key, size, expected_sha256)])
+
+
+def enqueue_many(cur, jobs):
+    """jobs: [(file_id, s3_key, size, expected_sha256)] -> ein Multi-Row-Insert + ein NOTIFY."""
+    if not jobs: return
+    cur.execute(ENQUEUE_SQL, _columns(jobs))
+    cur.execute(NOTIFY_SQL, (VERIFY_CHANNEL,))
+
+
+async def enqueue_many_async(conn, jobs):
+    """Async-Modus (asyncpg-Connection in laufender Transaktion)."""
+    if not jobs: return
+    await conn.execute(numbered(ENQUEUE_SQL), *_columns(jobs))
+    await conn.execute(numbered(NOTIFY_SQL), VERIFY_CHANNEL)
+
+
+class Verifier:
+    def __init__(self, storage, pool, workers=WORKERS, prefetch=PREFETCH, range_bytes=RANGE_BYTES):
+        self.storage = storage
+        self.pool = pool
+        self.workers = max(1, workers)
+        self.prefetch = max(1, prefetch)
+        self.range_bytes = range_bytes
+        self.hashers = ThreadPoolExecutor(self.workers, thread_name_prefix="verify")
+        self.fetchers = ThreadPoolExecutor(self.workers * self.prefetch, thread_name_prefix="range-get")
+        # ein Puffersatz pro Hash-Worker, wird über alle Jobs wiederverwendet
+        self._buffers = queue.Queue()
+        for _ in range(self.workers):
+            self._buffers.put([bytearray(range_bytes) for _ in range(self.prefetch)])
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def sha256(self, key, size):
+        """Ranged-GETs laufen bis zu prefetch voraus; Puffer i wird erst nach dem Hashen
+        von Range i für Range i+prefetch wiederverwendet."""
+        bufs = self._buffers.get()
+        t0 = time.perf_counter()
+        try:
+            h = hashlib.sha256()
+            ranges = iter(enumerate(range(0, size, self.range_bytes)))
+            pending = deque()
+            def submit():
+                nxt = next(ranges, None)
+                if nxt is None: return
+                i, start = nxt
+                end = min(start + self.range_bytes, size)
+                buf = bufs[i % len(bufs)]
+                pending.append((end - start, buf, self.fetchers.submit(self.storage.read_range_into, key, start, end, buf)))
+            for _ in bufs: submit()
+            while pending:
+                want, buf, fut = pending.popleft()
+                n = fut.result()
+                if n != want:
+                    raise IOError(f"short read on {key}: {n} of {want} bytes")
+                h.update(memoryview(buf)[:n])   # hashlib gibt bei großen Blöcken das GIL frei
+                metrics.HASHED_BYTES.inc(n)
+                submit()
+            metrics.HASH_SECONDS.observe(time.perf_counter() - t0)
+            return h.hexdigest()
+        finally:
+            self._buffers.put(bufs)
+
+    def claim(self, n):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+              update verify_job set leased_until = now() + (%s)::interval, attempts = attempts + 1
+              where file_id in (
+                select file_id from verify_job
+                where leased_until is null or leased_until < now()
+                order by enqueued_at
+                limit %s
+                for update skip locked)
+              returning file_id::text, s3_key, size_bytes, expected_sha256, attempts
+            """, (f"{LEASE_S} seconds", n))
+            return cur.fetchall()
+
+    def finish(self, fid, state, key, new_key=None, meta=None):
+        with self.pool.cursor() as cur:
+            cur.execute("update file_object set verify_state=%s, s3_key=coalesce(%s, s3_key), "
+                        "thumb_key=case when %s is null then thumb_key end where id=%s",
+                (state, new_key, new_key, fid))
+            cur.execute("delete from verify_job where file_id=%s", (fid,))
+            # verifiziert -> als Dedup-Blob verfügbar (UPLOAD_DEDUP)
+            if state == "ok": blobs.register(cur, fid)
+            # Mismatch verschwindet aus den Listings (evtl. mit neuem s3_key) -> Caches invalidieren
+            if state == "mismatch": cur.execute("select pg_notify('file_object_changed', '')")
+        audit.log(f"files.verify.{state}", "file_object", fid, dict(meta or {}, s3_key=key))
+        metrics.VERIFIED.labels(state).inc()
+
+    def process(self, job):
+        fid, key, size, expected, attempts = job
+        try:
+            got = self.sha256(key, size)
+        except Exception as e:
+            print(f"[verifier] {fid}: {e} (attempt {attempts})")
+            if attempts >= MAX_ATTEMPTS:
+                self.finish(fid, "error", key, meta={"error": str(e)[:200]})
+            return   # sonst: Lease läuft ab -> erneuter Versuch
+        if got == expected:
+            self.finish(fid, "ok", key)
+            return
+        qkey = QUARANTINE_PREFIX + key
+        try:
+            self.storage.copy(key, qkey)
+            self.storage.delete(key)
+            self.storage.delete(thumbs.thumb_key(key))   # evtl. schon gerenderte Vorschau
+        except Exception as e:
+            print(f"[verifier] quarantine failed for {key}: {e}")
+            qkey = None
+        self.finish(fid, "mismatch", key, new_key=qkey, meta={"expected": expected, "actual": got})
+
+    def _run(self, job):
+        try: self.process(job)
+        except Exception as e: print(f"[verifier] {job[0]}: {e}")
+        finally:
+            with self._lock: self.in_flight -= 1
+
+    def fill(self):
+        """Claimt so viele Jobs, wie Hash-Worker frei sind -> Anzahl neu gestarteter Jobs."""
+        free = self.workers - self.in_flight
+        if free <= 0: return 0
+        jobs = self.claim(free)
+        for job in jobs:
+            with self._lock: self.in_flight += 1
+            self.hashers.submit(self._run, job)
+        return len(jobs)
+
+
+def listen():
+    conn = psycopg2.connect(DB_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"listen {VERIFY_CHANNEL}")
+    return conn
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--poll-seconds", type=float, default=float(os.getenv("VERIFY_POLL_SECONDS","30")),
+        help="Fallback-Poll, falls ein NOTIFY verloren geht")
+    ap.add_argument("--metrics-port", type=int, default=int(os.getenv("VERIFY_METRICS_PORT","0")),
+        help="Prometheus-Exporter auf diesem Port (0 = aus)")
+    args = ap.parse_args()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))   # atexit flusht den Audit-Puffer
+    metrics.serve(args.metrics_port)
+    storage = S3Storage(S3_BUCKET, os.getenv("S3_ENDPOINT"), os.getenv("S3_ACCESS_KEY"), os.getenv("S3_SECRET_KEY"))
+    pool = get_pool(dsn=DB_URL, minconn=0, maxconn=WORKERS + 2)
+    v = Verifier(storage, pool)
+    metrics.register_stats("db_pool", pool.stats)
+    metrics.register_stats("verifier", lambda: {"in_flight": v.in_flight, "workers": v.workers})
+    print(f"[verifier] workers={v.workers} prefetch={v.prefetch} range={v.range_bytes} bytes")
+    listener = None
+    while True:
+        try:
+            if listener is None or listener.closed:
+                listener = listen()
+            started = v.fill()
+            # alle Worker belegt oder gerade gefüllt -> kurz warten, sonst bis NOTIFY/Poll
+            timeout = 0.5 if started or v.in_flight >= v.workers else args.poll_seconds
+            if select.select([listener], [], [], timeout) != ([], [], []):
+                listener.poll(); listener.notifies.clear()
+        except Exception as e:
+            print(f"[verifier] ERROR: {e}")
+            listener = None
+            time.sleep(5)
+
+
+if __name__ == "__main__":
+    main()
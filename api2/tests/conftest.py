@@ -0,0 +1,4 @@
+import os, sys
+
+# app.* importierbar, egal aus welchem Verzeichnis pytest läuft
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
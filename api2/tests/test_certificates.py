@@ -0,0 +1,96 @@
+"""Gate-Regeln (app/certificates.py): Parser, Null-Semantik, Notenstufen, Config-Prüfung, Cache."""
+import os
+import pytest
+from app import certificates
+from app.certificates import RuleError, compiled, from_file, parse
+
+CFG = {
+    "grade_bands": {"gut": {"min": 80}, "mittel": {"min": 50, "max": 79}, "schwach": {"max": 49}},
+    "rules": {"G1": {"must": ["a >= 1 OR b >= 1 AND c >= 1"]},
+              "G2": {"must": ["NOT (x < 3.0 AND y < 3.0)", "flag == true"]}},
+    "finals": {"gate_fail_overrides_grade": True},
+}
+
+
+def test_precedence_and_before_or():
+    assert parse("a OR b AND c") == ("or", [("cmp", "!=", ("var", "a"), ("const", 0.0)),
+                                           ("and", [("cmp", "!=", ("var", "b"), ("const", 0.0)),
+                                                    ("cmp", "!=", ("var", "c"), ("const", 0.0))])])
+    assert parse("NOT a == 1")[0] == "not"
+    r = compiled({"rules": {"G": {"must": ["a >= 1 OR b >= 1 AND c >= 1"]}}})
+    out = r.evaluate({"a": [1, 0, 0], "b": [0, 1, 1], "c": [0, 0, 1]})
+    assert out["passed"] == [True, False, True]
+
+
+def test_missing_value_fails_clause_even_under_not():
+    r = compiled({"rules": {"G": {"must": ["NOT (x < 3)"]}}})
+    out = r.evaluate({"x": [5, 1, None]})
+    assert out["passed"] == [True, False, False]
+    assert out["failing"][2] == ["G: NOT (x < 3)"]
+    # Spalte fehlt ganz -> wie lauter None
+    out = r.evaluate({"y": [1, 2]})
+    assert out["passed"] == [False, False] and out["missing_columns"] == ["x"]
+
+
+def test_grade_bands_and_gate_override():
+    r = compiled(CFG)
+    cols = {"a": [1, 1, 1, 1, 0], "b": [0] * 5, "c": [0] * 5, "x": [5] * 5, "y": [5] * 5,
+            "flag": [True] * 5, "score": [95, 80, 79.5, None, 90]}
+    out = r.evaluate(cols, details=False)
+    assert out["grade_by_score"] == ["gut", "gut", "mittel", None, "gut"]
+    # G1 für den letzten Teilnehmer nicht bestanden -> unterste Stufe
+    assert out["grade"] == ["gut", "gut", "mittel", None, "schwach"]
+    assert "failing" not in out
+
+
+@pytest.mark.parametrize("cfg", [
+    {"rules": []},
+    {"rules": {}},
+    {"rules": {"G": "a > 1"}},
+    {"rules": {"G": {"must": "a > 1"}}},
+    {"rules": {"G": {"must": ["a >"]}}},
+    {"rules": {"G": {"must": ["a > 1"]}}, "grade_bands": ["gut"]},
+    {"rules": {"G": {"must": ["a > 1"]}}, "grade_bands": {"gut": 80}},
+    {"rules": {"G": {"must": ["a > 1"]}}, "grade_bands": {"gut": {"min": "viel"}}},
+    {"rules": {"G": {"must": ["a > 1"]}}, "finals": True},
+])
+def test_bad_config_is_rule_error(cfg):
+    with pytest.raises(RuleError):
+        compiled(cfg)
+
+
+def test_deep_nesting_is_rule_error():
+    with pytest.raises(RuleError):
+        parse("(" * 500 + "a" + ")" * 500)
+    with pytest.raises(RuleError):
+        parse("NOT " * 500 + "a")
+    with pytest.raises(RuleError):
+        parse(" OR ".join(["a"] * 1000))
+    assert parse("(" * 10 + "a" + ")" * 10) == ("cmp", "!=", ("var", "a"), ("const", 0.0))
+
+
+def test_compiled_cached_by_config_hash():
+    assert compiled(CFG) is compiled(dict(CFG))
+    assert compiled(CFG) is not compiled({**CFG, "finals": {}})
+
+
+def test_from_file_reloads_on_change(tmp_path):
+    path = tmp_path / "certificate.yaml"
+    path.write_text('rules:\n  G1: { must: ["a >= 1"] }\n', encoding="utf-8")
+    r1 = from_file(str(path))
+    assert from_file(str(path)) is r1
+    assert r1.evaluate({"a": [1, 0]})["passed"] == [True, False]
+    path.write_text('rules:\n  G1: { must: ["a >= 0"] }\n', encoding="utf-8")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    r2 = from_file(str(path))
+    assert r2 is not r1 and r2.evaluate({"a": [1, 0]})["passed"] == [True, True]
+
+
+def test_shipped_config_compiles():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                        "config", "certificate.yaml")
+    r = from_file(path)
+    assert r.gates == ["G1", "G2", "G3", "G4", "G5"]
+    assert r.fail_band == "nicht_bestanden"
+    assert certificates.SCORE_COLUMN in r.columns
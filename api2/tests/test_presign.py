@@ -0,0 +1,68 @@
+"""Presigner (app/presign.py) muss byte-identisch zu botocore signieren.
+
+Gleicher Zeitstempel für beide Seiten: botocore liest die Uhr über
+datetime.datetime.utcnow() in botocore.auth, der Presigner bekommt now=.
+"""
+import datetime
+import boto3, botocore.auth
+import pytest
+from botocore.config import Config
+from app.presign import Presigner
+
+NOW = datetime.datetime(2024, 5, 17, 12, 34, 56)
+TS = NOW.replace(tzinfo=datetime.timezone.utc).timestamp()
+BUCKET = "artifacts"
+KEYS = ["t-default/5b0f3c1e-8d2a-4f51-9d0c-3e7a2b6c9f10/report.pdf",
+        "t-default/5b0f3c1e-8d2a-4f51-9d0c-3e7a2b6c9f10/My File (1) +&=.png",
+        "t-default/5b0f3c1e-8d2a-4f51-9d0c-3e7a2b6c9f10/Prüfung_ä~.txt"]
+ENDPOINTS = ["http://127.0.0.1:9000", "http://minio:9000", "https://s3.example.com"]
+
+
+class FrozenDatetime(datetime.datetime):
+    @classmethod
+    def utcnow(cls):
+        return NOW
+
+
+@pytest.fixture(autouse=True)
+def frozen_clock(monkeypatch):
+    monkeypatch.setattr(botocore.auth.datetime, "datetime", FrozenDatetime)
+
+
+def clients(endpoint):
+    s3 = boto3.client("s3", endpoint_url=endpoint, aws_access_key_id="AKIDEXAMPLE",
+        aws_secret_access_key="wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+        config=Config(s3={"addressing_style": "path"}, signature_version="s3v4"), region_name="us-east-1")
+    p = Presigner(endpoint, "AKIDEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", BUCKET, region="us-east-1")
+    return s3, p
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+@pytest.mark.parametrize("key", KEYS)
+def test_get_matches_botocore(endpoint, key):
+    s3, p = clients(endpoint)
+    want = s3.generate_presigned_url("get_object", Params={"Bucket": BUCKET, "Key": key}, ExpiresIn=900)
+    assert p.get_url(key, 900, now=TS) == want
+    assert p.get_urls([key, key], 900, now=TS) == [want, want]
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+@pytest.mark.parametrize("key", KEYS)
+@pytest.mark.parametrize("content_type", ["application/pdf", "text/plain; charset=utf-8"])
+def test_put_matches_botocore(endpoint, key, content_type):
+    s3, p = clients(endpoint)
+    want = s3.generate_presigned_url("put_object",
+        Params={"Bucket": BUCKET, "Key": key, "ContentType": content_type}, ExpiresIn=900)
+    assert p.put_url(key, content_type, 900, now=TS) == want
+    assert p.put_urls([(key, content_type)], 900, now=TS) == [want]
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+@pytest.mark.parametrize("key", KEYS)
+def test_upload_part_matches_botocore(endpoint, key):
+    s3, p = clients(endpoint)
+    upload_id = "2~iCw_lDY8VoFp3JmwhSA1nTT7YJMGBbV"
+    want = [s3.generate_presigned_url("upload_part",
+                Params={"Bucket": BUCKET, "Key": key, "UploadId": upload_id, "PartNumber": n}, ExpiresIn=900)
+            for n in (1, 2, 10000)]
+    assert p.upload_part_urls(key, upload_id, [1, 2, 10000], 900, now=TS) == want